@@ -0,0 +1,219 @@
+import io
+import os
+import pickle
+import tempfile
+import time
+import tracemalloc
+
+import mmparser
+
+
+def makeTable(rows):
+    lines = ['| name | value |', '|:---- | ----:|']
+    for i in range(rows):
+        lines.append('| item{0} | {0} |'.format(i))
+    return '\n'.join(lines) + '\n'
+
+def makeList(items):
+    return '\n'.join('* item *{0}* `{0}`'.format(i) for i in range(items)) + '\n'
+
+def makeParagraph(lines):
+    return '\n'.join('line **{0}** [link](http://example.com/{0})'.format(i) for i in range(lines)) + '\n'
+
+def makeOutline(items, depth=8):
+    # 深さdepthまで入れ子になったリスト
+    return '\n'.join('{}* item {}'.format('  ' * (i % depth), i) for i in range(items)) + '\n'
+
+def makeQuoteThread(lines, depth=24):
+    # 返信を重ねたメールのように、深さdepthまで入れ子になった引用
+    chunks = []
+    for i in range(lines):
+        level = depth - (i * depth // lines)
+        chunks.append('> ' * level + 'reply line {}'.format(i))
+    return '\n'.join(chunks) + '\n'
+
+def makeFencedCode(lines, block_lines=40):
+    # block_lines行ずつのフェンスで囲まれたコードが並んだ文書
+    chunks = []
+    for i in range(lines):
+        if i % block_lines == 0:
+            chunks.append('```python' if i == 0 else '```\n\n```python')
+        chunks.append('    value_{0} = compute({0}) * 2  # *not* **inline**'.format(i))
+    chunks.append('```')
+    return '\n'.join(chunks) + '\n'
+
+def benchmarkParse(name, generator, sizes):
+    print('parse: {}'.format(name))
+    for size in sizes:
+        text = generator(size)
+        start = time.perf_counter()
+        mmparser.MarkdownParser().parseText(text)
+        elapsed = time.perf_counter() - start
+        print('  {:>8} lines: {:8.4f} s ({:6.3f} us/line)'.format(size, elapsed, elapsed / size * 1e6))
+
+def benchmarkRender(name, generator, sizes):
+    # ノード数を増やしたときにexpandToHTML()の時間が線形に増えることを確認する
+    print('render: {}'.format(name))
+    for size in sizes:
+        parser = mmparser.MarkdownParser()
+        parser.parseText(generator(size))
+        start = time.perf_counter()
+        parser.rootobject.expandToHTML()
+        elapsed = time.perf_counter() - start
+        print('  {:>8} nodes: {:8.4f} s ({:6.3f} us/node)'.format(size, elapsed, elapsed / size * 1e6))
+
+def benchmarkResume(name, generator, size, appended=10):
+    # 末尾にappended行ずつ追加される文書で、全体の解析とresume()の時間を比べる
+    lines = generator(size).split('\n')[:-1]
+    parser = mmparser.MarkdownParser()
+    checkpoint = parser.parseResumable(lines[:-appended])
+    start = time.perf_counter()
+    parser.resume(checkpoint, lines[-appended:])
+    resumed = time.perf_counter() - start
+    start = time.perf_counter()
+    parser.parse('\n'.join(lines) + '\n')
+    full = time.perf_counter() - start
+    print('resume: {}: {} lines, full parse {:8.4f} s, resume of {} lines {:8.4f} s'.format(
+        name, len(lines), full, appended, resumed))
+
+def benchmarkRenderCache(name, generator, size):
+    # 1行だけ変更した文書を描画し直すときの時間を、描画結果のキャッシュの有無で比べる
+    lines = generator(size).split('\n')
+    edited = list(lines)
+    edited[len(edited) // 2] = 'edited line'
+    for cache_enabled in (False, True):
+        cache = mmparser.enableRenderCache() if cache_enabled else None
+        if not cache_enabled:
+            mmparser.disableRenderCache()
+        parser = mmparser.MarkdownParser()
+        parser.parse('\n'.join(lines)).expandToHTML()
+        document = parser.parse('\n'.join(edited))
+        start = time.perf_counter()
+        document.expandToHTML()
+        elapsed = time.perf_counter() - start
+        print('render cache: {}: {} lines, cache {}: {:8.4f} s{}'.format(
+            name, size, 'on' if cache_enabled else 'off', elapsed,
+            ', hit rate {:.3f}'.format(cache.info()['hit_rate']) if cache else ''))
+    mmparser.disableRenderCache()
+
+def makeSections(sections):
+    # 見出し、段落、リスト、表からなる節が並んだ文書
+    chunks = []
+    for i in range(sections):
+        chunks.append('## section {0}\n\ntext of **section** {0}\n\n* a {0}\n* b\n\n| k | v |\n|---|---|\n| {0} | x |\n'.format(i))
+    return '\n'.join(chunks)
+
+def benchmarkDiskCache(files, size):
+    # diskCacheを使ったconvertMany()を2回実行し、2回目(全て変更なし)の時間を1回目と比べる
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for i in range(files):
+            paths.append(os.path.join(directory, 'src', 'doc{}.md'.format(i)))
+            os.makedirs(os.path.dirname(paths[-1]), exist_ok=True)
+            with open(paths[-1], 'wt', encoding='utf-8') as f:
+                f.write(makeSections(size) + '\n<!-- {} -->\n'.format(i))
+        cache = mmparser.diskCache(os.path.join(directory, 'cache'))
+        for run in ('cold', 'warm'):
+            start = time.perf_counter()
+            mmparser.convertMany(paths, os.path.join(directory, 'html'), workers=1, cache=cache)
+            print('disk cache: {} files, {}: {:8.4f} s'.format(files, run, time.perf_counter() - start))
+
+def checkDiskCache():
+    # キャッシュを使っても出力が変わらないことを確かめる。入れ子のブロックの中の定義は、parseFile()では
+    # 前のリンクにも届くが、convertFile()の逐次変換では届かないので、同じファイルを両方の順で変換する。
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'doc.md')
+        with open(path, 'wt', encoding='utf-8') as f:
+            f.write('see [a][x]\n\n> [x]: http://nested\n')
+
+        def convert(cache):
+            filename = os.path.join(directory, 'doc.html')
+            mmparser.MarkdownParser(cache).convertFile(path, filename)
+            with open(filename, 'rt', encoding='utf-8') as f:
+                return f.read()
+
+        def export(cache):
+            parser = mmparser.MarkdownParser(cache)
+            parser.parseFile(path)
+            sink = io.StringIO()
+            parser.exportHTML(sink=sink)
+            return sink.getvalue()
+
+        expected = {render: render(None) for render in (convert, export)}
+        failures = 0
+        for order in ((convert, export), (export, convert)):
+            cache = mmparser.diskCache(tempfile.mkdtemp(dir=directory))
+            failures += sum(1 for render in order if render(cache) != expected[render])
+    print('disk cache: {} / 4 outputs differ from no cache'.format(failures))
+    return failures
+
+def benchmarkSerialize(name, generator, size):
+    # dumps()/loads()の時間と大きさを、pickleと解析し直す場合と比べる
+    text = generator(size)
+    start = time.perf_counter()
+    document = mmparser.parse(text)
+    parsed = time.perf_counter() - start
+    for label, dump, load in (('dumps', mmparser.dumps, mmparser.loads),
+                              ('pickle', lambda element: pickle.dumps(element, pickle.HIGHEST_PROTOCOL), pickle.loads)):
+        start = time.perf_counter()
+        data = dump(document)
+        dumped = time.perf_counter() - start
+        start = time.perf_counter()
+        load(data)
+        loaded = time.perf_counter() - start
+        print('serialize: {}: {}: {} bytes, dump {:8.4f} s, load {:8.4f} s (parse {:8.4f} s)'.format(
+            name, label, len(data), dumped, loaded, parsed))
+
+def countNodes(element):
+    count = 1
+    for child in getattr(element, 'parsed_data', ()):
+        if isinstance(child, mmparser.defined_classes):
+            count += countNodes(child)
+    return count
+
+def benchmarkMemory(name, generator, size):
+    # 解析後の木が保持しているメモリを、ノード1つあたりのバイト数で表示する
+    text = generator(size)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    parser = mmparser.MarkdownParser()
+    parser.parseText(text)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    nodes = countNodes(parser.rootobject)
+    print('memory: {}: {} nodes, {:8.1f} bytes/node, {:6.1f} MB'.format(
+        name, nodes, (after - before) / nodes, (after - before) / 1e6))
+
+def benchmarkFlatMemory(name, generator, size):
+    # parseTextFlat()で作ったflatDocumentが保持しているメモリ(元の文書を含む)
+    text = generator(size)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    document = mmparser.MarkdownParser().parseTextFlat(text)
+    document.getBuffer()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # テキストのノードも数えるので、ノード数は木の場合より多くなる
+    print('memory: {} (flat): {} nodes, {:8.1f} bytes/node, {:6.1f} MB'.format(
+        name, len(document), (after - before) / len(document), (after - before) / 1e6))
+
+
+if __name__ == '__main__':
+    sizes = [1000, 4000, 16000, 64000]
+    benchmarkParse('table rows', makeTable, sizes)
+    benchmarkParse('outline (depth 8)', makeOutline, sizes)
+    benchmarkParse('quote thread (depth 24)', makeQuoteThread, sizes)
+    benchmarkParse('fenced code', makeFencedCode, sizes)
+    benchmarkRender('table rows', makeTable, sizes)
+    benchmarkRender('list items', makeList, sizes)
+    benchmarkRender('paragraph lines', makeParagraph, sizes)
+    benchmarkResume('fenced code', makeFencedCode, 64000)
+    benchmarkRenderCache('sections', makeSections, 4000)
+    benchmarkDiskCache(200, 50)
+    checkDiskCache()
+    benchmarkSerialize('sections', makeSections, 4000)
+    benchmarkSerialize('paragraph lines', makeParagraph, 64000)
+    benchmarkMemory('list items', makeList, 100000)
+    benchmarkMemory('paragraph lines', makeParagraph, 100000)
+    benchmarkFlatMemory('list items', makeList, 100000)
+    benchmarkFlatMemory('paragraph lines', makeParagraph, 100000)
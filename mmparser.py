@@ -1,4 +1,16 @@
+import array
+import bisect
+import concurrent.futures
+import hashlib
+import io
+import itertools
+import os
 import re
+import string
+import tempfile
+import threading
+import time
+import unicodedata
 import warnings
 from collections import OrderedDict
 
@@ -33,17 +45,8 @@ block_rules['TaggedBlockEnd'] = re.compile(r"""
 #インライン要素
 inline_rules = OrderedDict()
 inline_rules['LineBreak'] = re.compile(r'\s{2,}$')
-inline_rules['BoldFont'] = re.compile(r"""
-    (\*\*|\_\_)(.*?)\1
-""", re.VERBOSE)
-inline_rules['EmphasizedFont'] = re.compile(r"""
-    (\*|\_)(.*?)\1
-""", re.VERBOSE)
-inline_rules['DeletedFont'] = re.compile(r"""
-    \~\~(.*?)\~\~
-""", re.VERBOSE)
 inline_rules['InlineCode'] = re.compile(r"""
-    (`{1,})(.*?)\1
+    (?P<code_mark>`{1,})(.*?)(?P=code_mark)
 """, re.VERBOSE)
 inline_rules['Links'] = re.compile(r"""
     (\[)
@@ -61,6 +64,23 @@ inline_rules['Images'] = re.compile(r"""
         (.*?)
     ([\]\)])
 """, re.VERBOSE)
+#強調記号の連続。太字・強調・消字はprocessEmphasis()で組み立てる。
+inline_rules['Delimiter'] = re.compile(r"""
+    \*+|\_+|\~+
+""", re.VERBOSE)
+#インライン要素の優先順位。同じ位置で複数のルールが合致する場合は先頭のものを採用する。
+inline_priority = [
+    'LineBreak',
+    'InlineCode',
+    'Images',
+    'Links',
+    'Delimiter',
+]
+#全てのインライン要素を名前付きグループの選択として1つの正規表現にまとめる。
+#合致したグループ名（lastgroup）から生成するクラスを決める。
+inline_master = re.compile('|'.join(
+    '(?P<{}>{})'.format(name, inline_rules[name].pattern) for name in inline_priority
+), re.VERBOSE)
 
 #その他個別ルール
 blank_line = re.compile(r"""
@@ -92,6 +112,24 @@ block_quote = re.compile(r"""
     (&gt;|\>)        #symbol that tells this line is a start of blockquote
     (.*)
 """, re.VERBOSE)
+#表の行の区切り。'\|'は区切りではない。
+table_separator = re.compile(r'(?<!\\)\|')
+#表の2行目で、|---|---|タイプか---|---タイプかを判別する
+table_formal = re.compile(r'\s*\|')
+table_informal = re.compile(r'\s*[^ \|]')
+table_left_align = re.compile(r'\s*\:(\-{3,})\s*$')
+table_right_align = re.compile(r'(\s*\-{3,})\:\s*$')
+table_center_align = re.compile(r'\s*\:(\-{3,})\:\s*$')
+#引用の行頭から取り除く、1階層分の記号
+quote_marker = re.compile(r"""
+    (&gt;|\>)\s?
+""", re.VERBOSE)
+#フェンスで囲まれたコードの開始行。`のフェンスのinfo文字列には`を含められない。
+fenced_code = re.compile(r"""
+    \s{0,3}
+    (?P<fence>`{3,}(?=[^`]*$)|~{3,})    #symbol that tells this line is a start of fenced code
+    \s*(?P<info>.*?)\s*$
+""", re.VERBOSE)
 definition_block = re.compile(r"""
     (\[)
     ([^\[]+)
@@ -99,141 +137,1635 @@ definition_block = re.compile(r"""
     \:
     (.*)
 """, re.VERBOSE)
+definition_id = re.compile(r"(\[)(?P<id>[^\[]+)(\]:)")
+definition_option = re.compile(r'([\"\'\(])(?P<option>.*)\1')
+
+#blockObject.parse()の状態。state_handlersの表のインデックスになる。
+STATE_BLANK = 0
+STATE_NORMAL = 1
+STATE_TABLE = 2
+STATE_BLOCK_QUOTE = 3
+STATE_TAGGED_BLOCK = 4
+STATE_CODE_BLOCK = 5
+STATE_UL_LISTS = 6
+STATE_OL_LISTS = 7
+STATE_FENCED_CODE = 8
+#リストの中の行の種類。block_rulesのリストの正規表現は行頭の空白を問わないので、
+#入れ子のリストでインデントを取り除いても行の種類は変わらない。
+LINE_TEXT = 0
+LINE_UL = 1
+LINE_OL = 2
+LINE_BLANK = 3
+#flatDocumentのノードの種類のうち、クラスを持たないもの。
+#クラスを持つ要素の種類はFLAT_CLASS_OFFSET + defined_classesでの位置になる。
+NODE_TEXT = 0
+NODE_TABLE_HEADER = 1
+NODE_TABLE_ROW = 2
+NODE_TABLE_HEADER_CELL = 3
+NODE_TABLE_CELL = 4
+NODE_ATTRIBUTE = 5
+FLAT_CLASS_OFFSET = 6
+#インデントの幅を数えるときのタブの幅
+TAB_WIDTH = 4
+#dumps()の形式の先頭の4バイトと、その後に続く残り全体のblake2bの大きさ、各値の先頭の1バイト(値の種類)
+DUMP_MAGIC = b'MMD2'
+DUMP_CHECKSUM_SIZE = 16
+DUMP_NONE = 0
+DUMP_TRUE = 1
+DUMP_FALSE = 2
+DUMP_INT = 3
+DUMP_STRING = 4
+DUMP_LIST = 5
+DUMP_DICT = 6
+DUMP_SHARED = 7
+DUMP_ARRAY = 8
+DUMP_NODE = 9
+#block_rulesの名前と、その行から始まるブロックの状態の対応
+block_states = {
+    'ulLists'        : STATE_UL_LISTS,
+    'olLists'        : STATE_OL_LISTS,
+    'CodeBlock'      : STATE_CODE_BLOCK,
+    'Table'          : STATE_TABLE,
+    'TaggedBlock'    : STATE_TAGGED_BLOCK,
+    #閉じタグだけの行は通常文として続ける
+    'TaggedBlockEnd' : STATE_NORMAL,
+}
+
+#parseFirstTime()で試すルールの一覧。上から順に試し、最初に合致したものを採用する。
+#(名前, 正規表現, 行頭の空白以外の最初の文字(Noneは制限なし), 最小のインデント, 最大のインデント, 行に含まれるべき文字列)
+first_time_rules = [
+    ('TaggedLine'     , tagged_line                   , '<'         , 0, None, None),
+    ('ulLists'        , block_rules['ulLists']        , '*+-'       , 0, None, None),
+    ('olLists'        , block_rules['olLists']        , '0123456789', 0, None, None),
+    ('FencedCode'     , fenced_code                   , '`~'        , 0, 3   , None),
+    ('CodeBlock'      , block_rules['CodeBlock']      , None        , 4, None, None),
+    ('Table'          , block_rules['Table']          , None        , 0, None, '|' ),
+    ('TaggedBlock'    , block_rules['TaggedBlock']    , '<'         , 0, None, None),
+    ('TaggedBlockEnd' , block_rules['TaggedBlockEnd'] , None        , 0, None, '<' ),
+    ('BlockQuote'     , block_quote                   , '>&'        , 0, 0   , None),
+    ('Header'         , header_block                  , '#'         , 0, None, None),
+    ('HorizontalRule' , horizontal_rule               , '-*_'       , 0, 0   , None),
+    ('Definition'     , definition_block              , '['         , 0, 0   , None),
+]
+#最初の文字をキーとして、試すべきルールを順番通りに並べた索引
+default_candidates = [entry for entry in first_time_rules if entry[2] is None]
+first_char_index = {}
+for entry in first_time_rules:
+    for char in entry[2] or '':
+        first_char_index[char] = [
+            candidate for candidate in first_time_rules
+            if candidate[2] is None or char in candidate[2]
+        ]
 
 
 class MarkdownParser:
-    def __init__(self):
+    def __init__(self, cache=None):
+        #cacheはdiskCache。parseFile()、exportHTML()、convertFile()の結果をディスクに保存する。
         self.rootobject = root([])
+        self.cache = cache
+        #diskCacheから読み込んだか保存した木と、その元のファイルのキー
+        self.cached_source = (None, None)
         return
 
     def parseFile(self, filepath):
         """
         This function will read markdown file and parse it.
         Only a file encoded with UTF-8 is appliable.
+        With a diskCache, a file parsed before is loaded from the cache.
         """
-        #ファイルを行ごとに分割してlist形式にする
+        #前回の解析結果には追加せず、新しい木を作る
+        self.rootobject = root([])
+        if self.cache is not None:
+            with open(filepath, 'rb') as f:
+                data = f.read()
+            key = self.cache.makeKey(data)
+            document = self.cache.loadTree(key)
+            if document is None:
+                self.parseOpenedFile(io.StringIO(data.decode('utf-8'), newline=None))
+                self.cache.storeTree(key, self.rootobject)
+            else:
+                self.rootobject = document
+            self.cached_source = (self.rootobject, key)
+            return
+        #ファイル全体を読み込まず、1行ずつ解析する
         with open(filepath, 'rt', encoding='utf-8') as f:
-            data = f.read()
-            splitted_data = []
-            for line in data.split('\n'):
-                splitted_data.append(line)
-            #parse関数の処理の都合上、末尾に空行を挿入する。
-            splitted_data.append('')
-            self.rootobject.rawdata = splitted_data
-        self.rootobject.parse()
+            self.parseOpenedFile(f)
+
+    def parseOpenedFile(self, f):
+        #後方で定義されるリンクのidを解決するため、先に定義だけを集める。
+        references = self.collectReferences(self.splitLines(f), self.rootobject.references)
+        f.seek(0)
+        #parse関数の処理の都合上、末尾に空行を挿入する。
+        lines = itertools.chain(self.splitLines(f), [''])
+        defined_count = len(references)
+        self.rootobject.parsed_data.extend(self.parseStream(lines, references))
+        self.resolveNestedDefinitions(self.rootobject.parsed_data, references, defined_count)
 
     def parseText(self, textdata):
-        data = textdata
-        splitted_data = []
-        for line in data.split('\n'):
-            splitted_data.append(line)
+        self.rootobject = self.parse(textdata)
+
+    def parse(self, textdata):
+        """
+        This function will parse textdata and return a new root element.
+        Neither this parser nor its rootobject is modified, so the same
+        parser can be used from many threads at once.
+        """
+        lines = textdata.split('\n')
+        document = root([])
+        self.collectReferences(lines, document.references)
+        defined_count = len(document.references)
+        document.parsed_data.extend(self.parseStream(lines, document.references))
+        self.resolveNestedDefinitions(document.parsed_data, document.references, defined_count)
+        return document
+
+    def parseTextFlat(self, textdata):
+        """
+        This function will parse textdata into a flatDocument (see below)
+        instead of rootobject. Each top-level element is flattened as soon as
+        it is parsed, so the whole tree is never held in memory.
+        """
+        lines = textdata.split('\n')
+        references = self.collectReferences(lines)
+        document = flatDocument(textdata)
+        for element in self.parseStream(lines, references):
+            document.appendElement(element)
+        return document
+
+    def parseStream(self, lines, references=None):
+        """
+        This function will parse an iterable of lines (without newlines) and
+        yield each top-level element as soon as its block is closed.
+        Yielded elements are not kept in rootobject, so memory usage is
+        bounded by the largest block instead of the whole document.
+        Link ids are resolved with references (see collectReferences()) and
+        the definitions found so far. Definitions found while parsing are
+        added to references.
+        """
+        if references is None:
+            references = {}
+        for _, _, elements in self.iterSteps(lines, 0, references):
+            for element in elements:
+                yield element
+
+    def iterSteps(self, lines, start, references):
+        """
+        This function will parse lines (from lines[start] if it is a list)
+        and yield (number of lines parsed, whether no block is open, the
+        top-level elements closed in this step) after each step.
+        Link ids of the elements are resolved with references. While the
+        render cache is enabled, each element also gets a fingerprint: a
+        hash of the lines since the last point where no block was open (the
+        parse of an element depends on nothing before it), its position
+        among the elements closed since then, and references if the lines
+        may contain links.
+        """
+        feeder = root([])
+        feeder.references = references
+        feeder.startFeed()
+        fingerprinting = render_cache is not None
+        listed = isinstance(lines, list)
+        if fingerprinting and not listed:
+            #リスト以外の行は、ブロックが開いていない位置からの分を記録しておく
+            recorded = []
+            lines = self.recordLines(lines, recorded)
+        boundary = 0
+        ordinal = 0
+        references_digest = (-1, None)
+        for _ in feeder.iterFeed(lines, start):
+            elements = feeder.parsed_data
+            if elements:
+                feeder.parsed_data = []
+                elements = [self.resolveElement(element, references) for element in elements]
+                if fingerprinting:
+                    source = lines[start + boundary:start + feeder.index] if listed else recorded
+                    #定義は追加されるだけなので、referencesのhashは定義の数が変わったときだけ計算し直す
+                    if references_digest[0] != len(references):
+                        references_digest = (len(references), self.digestReferences(references))
+                    ordinal = self.fingerprintElements(elements, source, ordinal, references_digest[1])
+            closed = feeder.state == STATE_BLANK
+            if closed:
+                boundary = feeder.index
+                ordinal = 0
+                if fingerprinting and not listed:
+                    del recorded[:]
+            yield feeder.index, closed, elements
+        feeder.closeFeed()
+        elements = [self.resolveElement(element, references) for element in feeder.parsed_data]
+        if fingerprinting and elements:
+            source = lines[start + boundary:start + feeder.index] if listed else recorded
+            self.fingerprintElements(elements, source, ordinal, self.digestReferences(references))
+        yield feeder.index, True, elements
+
+    @staticmethod
+    def recordLines(lines, recorded):
+        for line in lines:
+            recorded.append(line)
+            yield line
+
+    @staticmethod
+    def digestReferences(references):
+        return hashlib.blake2b(repr(sorted(references.items())).encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+    @staticmethod
+    def fingerprintElements(elements, source, ordinal, references_digest):
+        #sourceの行から、ordinal番目以降に閉じた要素のfingerprintを付ける。次の要素の順番を返す。
+        text = '\n'.join(source)
+        digest = hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16)
+        if '[' in text:
+            digest.update(references_digest)
+        prefix = digest.hexdigest()
+        for element in elements:
+            if isinstance(element, blockObject):
+                element.fingerprint = '{}-{}'.format(prefix, ordinal)
+            ordinal += 1
+        return ordinal
+
+    def parseFileParallel(self, filepath, workers=None, chunk_lines=None):
+        """
+        This function will parse a markdown file with parseLinesParallel().
+        """
+        with open(filepath, 'rt', encoding='utf-8') as f:
+            lines = list(self.splitLines(f))
         #parse関数の処理の都合上、末尾に空行を挿入する。
-        self.rootobject.rawdata = splitted_data
-        self.rootobject.parse()
+        lines.append('')
+        self.parseLinesParallel(lines, workers, chunk_lines)
+
+    def parseTextParallel(self, textdata, workers=None, chunk_lines=None):
+        self.parseLinesParallel(textdata.split('\n'), workers, chunk_lines)
+
+    def parseLinesParallel(self, lines, workers=None, chunk_lines=None):
+        """
+        This function will split lines at block boundaries (see findSplitPoints())
+        and parse the chunks in worker processes. The elements are merged into
+        rootobject in order, and link ids are resolved once all the
+        definitions of every chunk are known.
+        """
+        self.rootobject = root([])
+        references = self.collectReferences(lines, self.rootobject.references)
+        if chunk_lines is None:
+            #1ワーカーあたり数個のchunkになるようにする
+            chunk_lines = max(1000, len(lines) // ((workers or os.cpu_count() or 1) * 4))
+        points = self.findSplitPoints(lines, chunk_lines) + [len(lines)]
+        chunks = [lines[start:end] for start, end in zip(points, points[1:])]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            for parsed_data, chunk_references in executor.map(parseChunk, chunks):
+                #同じidが複数回定義された場合は、文書の中で最初の定義を使う
+                for id, id_information in chunk_references.items():
+                    references.setdefault(id, id_information)
+                self.rootobject.parsed_data.extend(parsed_data)
+        parsed_data = self.rootobject.parsed_data
+        for index in range(len(parsed_data)):
+            parsed_data[index] = self.resolveElement(parsed_data[index], references)
+
+    @staticmethod
+    def findSplitPoints(lines, chunk_lines):
+        """
+        This function will return the indices of lines where a chunk can start.
+        A chunk starts only where the parser has no open block (STATE_BLANK),
+        i.e. never inside a list, blockquote, code block, table or tagged
+        block, and each chunk has at least chunk_lines lines.
+        """
+        points = [0]
+        state = STATE_BLANK
+        base_indent = 0
+        next_point = chunk_lines
+        for index, text in enumerate(lines):
+            if state == STATE_BLANK and index >= next_point:
+                points.append(index)
+                next_point = index + chunk_lines
+            state, base_indent = blockObject.scanState(state, text, base_indent)
+        return points
+
+    @staticmethod
+    def resolveElement(element, references):
+        if isinstance(element, defined_classes):
+            return element.resolveReferences(references)
+        return element
+
+    def resolveNestedDefinitions(self, parsed_data, references, defined_count):
+        #引用などの中の定義は先に集められず、解析中にreferencesへ追加される。
+        #集めた定義の数(defined_count)より増えていれば、それより前の要素のリンクも解決し直す。
+        if len(references) > defined_count:
+            return self.updateElements(parsed_data, len(parsed_data), references)
+        return []
+
+    @staticmethod
+    def collectReferences(lines, references=None):
+        """
+        This function will scan lines for link definitions ("[id]: url") and
+        return them as a dictionary, so that ids used before their definition
+        are resolved by parseStream().
+        The lines are followed with scanState(), so a line is taken as a
+        definition only where the parser starts a new block with it, not
+        inside a code or tagged block or as the continuation of a paragraph.
+        """
+        if references is None:
+            references = {}
+        if isinstance(lines, list):
+            #状態を追うのは、定義の候補の最後の行まででよい
+            last = -1
+            for index, line in enumerate(lines):
+                if line[:1] == '[' and definition_block.match(line):
+                    last = index
+            lines = itertools.islice(lines, last + 1)
+        state = STATE_BLANK
+        base_indent = 0
+        for line in lines:
+            #リストの中でも、インデントされていない行はリストを閉じて新しいブロックになる
+            starts_block = state == STATE_BLANK or state == STATE_UL_LISTS or state == STATE_OL_LISTS
+            state, base_indent = blockObject.scanState(state, line, base_indent)
+            if starts_block and state == STATE_BLANK and line[:1] == '[' and definition_block.match(line):
+                id, id_information = blockObject.parseDefinition(line)
+                references.setdefault(id, id_information)
+        return references
+
+    def parseIncremental(self, textdata):
+        """
+        This function will parse textdata like parse() and return a root
+        element that can be updated with reparse() after each edit.
+        The root keeps the source lines in rawdata.
+        """
+        document = root(textdata.split('\n'))
+        self.fillIncremental(document)
+        return document
+
+    def fillIncremental(self, document):
+        #document.rawdataの全体を解析し直す
+        document.references = self.collectReferences(document.rawdata)
+        document.parsed_data = []
+        document.segment_lines = array.array('l')
+        document.segment_sizes = array.array('l')
+        defined_count = len(document.references)
+        for line_count, elements in self.iterSegments(document.rawdata, 0, document.references):
+            document.segment_lines.append(line_count)
+            document.segment_sizes.append(len(elements))
+            document.parsed_data.extend(elements)
+        self.resolveNestedDefinitions(document.parsed_data, document.references, defined_count)
+
+    def reparse(self, document, start, end, new_lines):
+        """
+        This function will replace lines start..end (end excluded) of a
+        document returned by parseIncremental() with new_lines and update
+        the document in place.
+        Parsing restarts at the last point before the edit where no block is
+        open, and stops at the first such point after the edit that was also
+        one before it, since the rest parses exactly as before. Only the
+        top-level elements of those lines are replaced in parsed_data.
+        If the edited lines or the lines parsed again around them contain a
+        link definition (an edit may join it to a paragraph, or open a code
+        block over it), the whole document is parsed again, because links
+        anywhere may change.
+        """
+        lines = document.rawdata
+        if any(']:' in line for line in itertools.chain(lines[start:end], new_lines)):
+            lines[start:end] = new_lines
+            self.fillIncremental(document)
+            return document
+        line_bounds = [0]
+        line_bounds.extend(itertools.accumulate(document.segment_lines))
+        element_bounds = [0]
+        element_bounds.extend(itertools.accumulate(document.segment_sizes))
+        #文書の末尾はブロックが開いたままかもしれないので、末尾への追加は最後の並びから解析する
+        first = max(min(bisect.bisect_right(line_bounds, start) - 1, len(document.segment_lines) - 1), 0)
+        lines[start:end] = new_lines
+        edit_end = start + len(new_lines)
+        delta = edit_end - end
+        position = line_bounds[first]
+        last = len(document.segment_lines)
+        segment_lines = array.array('l')
+        segment_sizes = array.array('l')
+        elements = []
+        for line_count, segment in self.iterSegments(lines, position, document.references):
+            position += line_count
+            segment_lines.append(line_count)
+            segment_sizes.append(len(segment))
+            elements.extend(segment)
+            if position >= edit_end:
+                #変更前にも区切りだった位置なら、以降の要素はそのまま使える
+                index = bisect.bisect_left(line_bounds, position - delta)
+                if index < len(line_bounds) and line_bounds[index] == position - delta:
+                    last = index
+                    break
+        #編集の前後の行も、ブロックのつながりが変わると定義として扱われるかどうかが変わることがある
+        if any(']:' in line for line in itertools.islice(lines, line_bounds[first], position)):
+            self.fillIncremental(document)
+            return document
+        document.parsed_data[element_bounds[first]:element_bounds[last]] = elements
+        document.segment_lines[first:last] = segment_lines
+        document.segment_sizes[first:last] = segment_sizes
+        return document
+
+    def iterSegments(self, lines, start, references):
+        #lines[start:]を解析し、ブロックが開いていない位置で区切った行の並びごとに、
+        #(行数, リンクのidを解決したトップレベルの要素のリスト)を返す。
+        position = 0
+        segment = []
+        for index, closed, elements in self.iterSteps(lines, start, references):
+            segment.extend(elements)
+            if closed and index > position:
+                yield index - position, segment
+                segment = []
+                position = index
+
+    def parseResumable(self, lines):
+        """
+        This function will parse complete lines (without the trailing empty
+        string of str.split()) and return a parseCheckpoint (see below).
+        Lines appended later are parsed with resume().
+        """
+        checkpoint = parseCheckpoint()
+        self.resume(checkpoint, lines)
+        return checkpoint
+
+    def resume(self, checkpoint, new_lines):
+        """
+        This function will parse new_lines appended after the lines of a
+        checkpoint. Only the lines after the last closed top-level block and
+        new_lines are parsed; the elements they gave before are replaced in
+        checkpoint.document. The checkpoint is moved to the new last closed
+        block.
+        Returns (elements, resolved): the elements parsed from the old
+        position of the checkpoint, and a list of (index, element) of the
+        closed elements before it whose links were resolved by definitions
+        in new_lines. Only these need to be rendered again.
+        """
+        document = checkpoint.document
+        new_lines = list(new_lines)
+        lines = checkpoint.text_buffer + new_lines
+        #text_bufferの先頭はブロックが開いていない位置なので、そこから状態を追って定義を探す
+        defined_count = len(document.references)
+        self.collectReferences(lines, document.references)
+        element_count = checkpoint.element_count
+        del document.parsed_data[element_count:]
+        #parseFile()と同じく末尾に空行を足して、開いたブロックも閉じた状態で描画できるようにする。
+        #足した空行で閉じたブロックは、続きの行が追加されるかもしれないので閉じたものとしない。
+        elements = []
+        position = 0
+        closed_position = 0
+        for line_count, segment in self.iterSegments(lines + [''], 0, document.references):
+            position += line_count
+            elements.extend(segment)
+            if position <= len(lines):
+                closed_position = position
+                checkpoint.index += line_count
+                checkpoint.element_count += len(segment)
+        checkpoint.text_buffer = lines[closed_position:]
+        document.parsed_data.extend(elements)
+        #後から定義されたidは、閉じたブロックのリンクも解決する
+        resolved = self.resolveNestedDefinitions(document.parsed_data, document.references, defined_count)
+        if resolved:
+            elements = document.parsed_data[element_count:]
+            resolved = [(index, element) for index, element in resolved if index < element_count]
+        return elements, resolved
+
+    def updateElements(self, parsed_data, count, references):
+        #parsed_dataの先頭count個の要素のリンクのidをreferencesで解決し直し、変わった要素の(位置, 要素)のリストを返す。
+        #変わった要素のfingerprintは、定義が増える前のreferencesのhashを含むので、新しいreferencesのhashを加えたものにする。
+        updated = []
+        references_digest = None
+        for index in range(count):
+            element = parsed_data[index]
+            if isinstance(element, blockObject):
+                if not element.updateReferences(references):
+                    continue
+                fingerprint = getattr(element, 'fingerprint', None)
+                if fingerprint is not None:
+                    if references_digest is None:
+                        references_digest = self.digestReferences(references)
+                    digest = hashlib.blake2b(fingerprint.encode('ascii'), digest_size=16)
+                    digest.update(references_digest)
+                    element.fingerprint = digest.hexdigest()
+            else:
+                resolved_element = self.resolveElement(element, references)
+                if resolved_element is element:
+                    continue
+                parsed_data[index] = element = resolved_element
+            updated.append((index, element))
+        return updated
+
+    def parseFileResumable(self, filepath):
+        """
+        This function will parse a growing file (such as a log or changelog)
+        and return a parseCheckpoint. Lines appended to the file later are
+        parsed with resumeFile().
+        """
+        checkpoint = parseCheckpoint()
+        self.resumeFile(checkpoint, filepath)
+        return checkpoint
+
+    def resumeFile(self, checkpoint, filepath):
+        """
+        This function will read the lines appended to filepath since the
+        checkpoint and parse them with resume(), returning its result. A last
+        line without a newline may still be being written, so it is left for
+        the next call.
+        """
+        with open(filepath, 'rb') as f:
+            f.seek(checkpoint.file_position)
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        checkpoint.file_position += end
+        text = data[:end].decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+        return self.resume(checkpoint, text.split('\n')[:-1])
+
+    def parseStreamFile(self, fileobj):
+        """
+        This function will parse a text file object with parseStream().
+        If the file can be rewound, its link definitions are collected first
+        (like convertFile()), so ids defined later in the file are resolved.
+        """
+        references = None
+        if fileobj.seekable():
+            position = fileobj.tell()
+            references = self.collectReferences(self.splitLines(fileobj))
+            fileobj.seek(position)
+        return self.parseStream(self.splitLines(fileobj), references)
+
+    @staticmethod
+    def splitLines(fileobj):
+        #ファイル全体を読み込まずに、str.split('\n')と同じ行の列を生成する。
+        line = ''
+        for line in fileobj:
+            if line.endswith('\n'):
+                yield line[:-1]
+            else:
+                yield line
+        if line == '' or line.endswith('\n'):
+            yield ''
     
-    def exportHTML(self, filename=None):
-        expanded_data = self.rootobject.expandToHTML()
+    def exportHTML(self, filename=None, sink=None):
+        """
+        This function will write HTML of the parsed document.
+        If sink (any object with a write() method) is given, HTML is written
+        to it instead of the file.
+        With a diskCache, the HTML of a file read by parseFile() is cached.
+        """
+        document, key = self.cached_source
+        if self.cache is not None and document is self.rootobject:
+            html = self.cache.loadHTML(key)
+            if html is None:
+                html = self.rootobject.expandToHTML()
+                self.cache.storeHTML(key, html)
+            if sink is not None:
+                sink.write(html)
+                return
+            with open(filename or 'export.html', 'wt', encoding='utf-8') as f:
+                f.write(html)
+            return
+        if sink is not None:
+            self.rootobject.writeHTML(sink)
+            return
         if filename == None:
             filename = 'export.html'
         with open(filename, 'wt', encoding='utf-8') as f:
-            f.write(expanded_data)
+            self.rootobject.writeHTML(f)
+
+    def convertStream(self, lines, sink, references=None):
+        """
+        This function will parse an iterable of lines and write HTML of each
+        top-level element to sink as soon as its block is closed.
+        Neither the document nor its HTML is held in memory as a whole.
+        """
+        self.rootobject.writeElements(self.parseStream(lines, references), sink)
+
+    def convertFile(self, filepath, filename=None):
+        """
+        This function will convert a markdown file to HTML with convertStream().
+        With a diskCache, the HTML of a file converted before is copied from
+        the cache without parsing it.
+        """
+        if filename == None:
+            filename = 'export.html'
+        if self.cache is not None:
+            with open(filepath, 'rb') as f:
+                data = f.read()
+            key = self.cache.makeKey(data)
+            html = self.cache.loadHTML(key, 'stream.html')
+            if html is None:
+                sink = io.StringIO()
+                self.convertOpenedFile(io.StringIO(data.decode('utf-8'), newline=None), sink)
+                html = sink.getvalue()
+                self.cache.storeHTML(key, html, 'stream.html')
+            with open(filename, 'wt', encoding='utf-8') as dst:
+                dst.write(html)
+            return
+        with open(filepath, 'rt', encoding='utf-8') as src, open(filename, 'wt', encoding='utf-8') as dst:
+            self.convertOpenedFile(src, dst)
+
+    def convertOpenedFile(self, src, dst):
+        references = self.collectReferences(self.splitLines(src))
+        src.seek(0)
+        #parse関数の処理の都合上、末尾に空行を挿入する。
+        lines = itertools.chain(self.splitLines(src), [''])
+        self.rootobject.writeElements(self.parseStream(lines, references), dst)
+
         
 
-#URLリンクのid情報を保存する辞書オブジェクト
-link_id_info = {}
+def parseChunk(lines):
+    #parseLinesParallel()のワーカーで、文書の一部を解析する。
+    #リンクのidの解決は、全てのchunkの定義を集めた後で行う。
+    chunk = root(lines)
+    chunk.parse()
+    return chunk.parsed_data, chunk.references
+
+def parse(textdata):
+    """
+    This function will parse textdata and return its root element.
+    It keeps no state between calls and is safe to call from many threads.
+    """
+    return MarkdownParser().parse(textdata)
+
+def convertFiles(tasks, cache=None):
+    """
+    This function will convert (markdown file, HTML file) pairs in this
+    process and return the result of each file. A failure of one file is
+    recorded in its result and does not stop the others.
+    """
+    results = []
+    for filepath, filename in tasks:
+        start = time.perf_counter()
+        error = None
+        try:
+            MarkdownParser(cache).convertFile(filepath, filename)
+        except Exception as e:
+            error = '{}: {}'.format(type(e).__name__, e)
+            #書きかけのHTMLファイルは残さない
+            if os.path.exists(filename):
+                os.remove(filename)
+        results.append({
+            'path': filepath,
+            'output': filename,
+            'seconds': time.perf_counter() - start,
+            'error': error,
+        })
+    return results
+
+def convertMany(paths, out_dir, workers=None, chunksize=16, cache=None):
+    """
+    This function will convert markdown files to HTML files in out_dir
+    using a pool of worker processes.
+    Files are sent to the workers in chunks of chunksize files.
+    The directory structure below the common directory of paths is kept.
+    Files that would be written to the same HTML file (such as a.md and
+    a.markdown) are found before converting: only the first of them is
+    converted, and the others fail with an error naming it.
+    With a diskCache, unchanged files are copied from the cache, which the
+    workers share through its directory.
+    It returns one result per file, in the order of paths:
+    {'path': ..., 'output': ..., 'seconds': ..., 'error': None or message}
+    """
+    paths = list(paths)
+    if len(paths) == 0:
+        return []
+    base_dir = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths])
+    tasks = []
+    outputs = []
+    #出力先のHTMLファイル→それに書き出すpathsの最初のファイル。2つ目以降は変換せずに失敗とする。
+    writers = {}
+    results = {}
+    for path in paths:
+        relative_path = os.path.relpath(os.path.abspath(path), base_dir)
+        filename = os.path.join(out_dir, os.path.splitext(relative_path)[0] + '.html')
+        outputs.append((path, filename))
+        output_key = os.path.normcase(os.path.abspath(filename))
+        if output_key in writers:
+            continue
+        writers[output_key] = path
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        tasks.append((path, filename))
+    chunks = [tasks[i:i + chunksize] for i in range(0, len(tasks), chunksize)]
+
+    if workers == 1:
+        #プロセスを起動せずに、このプロセスで順に変換する
+        for chunk in chunks:
+            for result in convertFiles(chunk, cache):
+                results[result['path']] = result
+        return collectResults(outputs, results, writers)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(convertFiles, chunk, cache): chunk for chunk in chunks}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                chunk_results = future.result()
+            except Exception as e:
+                #ワーカープロセス自体が失敗した場合は、そのchunkの全ファイルを失敗とする
+                chunk_results = [{
+                    'path': filepath,
+                    'output': filename,
+                    'seconds': 0.0,
+                    'error': '{}: {}'.format(type(e).__name__, e),
+                } for filepath, filename in futures[future]]
+            for result in chunk_results:
+                results[result['path']] = result
+    return collectResults(outputs, results, writers)
+
+def collectResults(outputs, results, writers):
+    #convertMany()の結果を、(ファイル, 出力先)の順に並べる。変換しなかった重複の分は失敗の結果を作る。
+    collected = []
+    converted = set()
+    for path, filename in outputs:
+        writer = writers[os.path.normcase(os.path.abspath(filename))]
+        if writer == path and path not in converted:
+            converted.add(path)
+            collected.append(results[path])
+        else:
+            collected.append({
+                'path': path,
+                'output': filename,
+                'seconds': 0.0,
+                'error': 'FileExistsError: {} is also the output of {}'.format(filename, writer),
+            })
+    return collected
+
+
+#このモジュールのソースのhash。parserVersion()で計算する。
+parser_version = None
+
+def parserVersion():
+    """
+    This function will return a hash of the source of this module, so that
+    entries of diskCache written by another version of the parser are
+    never read.
+    """
+    global parser_version
+    if parser_version is None:
+        try:
+            with open(__file__, 'rb') as f:
+                parser_version = hashlib.blake2b(f.read(), digest_size=16).digest()
+        except OSError:
+            #ソースが読めない場合は、他のプロセスのキャッシュを使わない
+            parser_version = os.urandom(16)
+    return parser_version
+
+class diskCache:
+    """
+    Cache of parsed trees (root elements serialized by dumps()) and
+    rendered HTML in a directory, which may be shared by many processes.
+    Entries are keyed by a hash of the markdown source and parserVersion().
+    Each entry is written to a temporary file and renamed into place, so
+    readers never see a partial entry. When the entries exceed max_bytes,
+    the least recently used ones (by modification time, which is updated
+    on every hit) are removed, down to eviction_ratio of max_bytes.
+    """
+    #書き込み途中のファイルの名前の接頭辞。この時間(秒)より古いものは、失敗した書き込みの残りとして削除する。
+    temporary_prefix = '.tmp-'
+    temporary_lifetime = 3600
+    #追い出すときは、max_bytesのこの割合まで減らす。毎回の書き込みで追い出しが起きないようにするため。
+    eviction_ratio = 0.9
+    #このプロセスが書き込んだ大きさは数えて足していくが、他のプロセスの書き込みを知るために、この回数ごとに数え直す。
+    rescan_interval = 256
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        #パス→大きさ。最初の書き込みのときにディレクトリを走査して作る。
+        self.entry_sizes = None
+        self.total_bytes = 0
+        self.stores_since_scan = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def makeKey(self, data):
+        #dataはファイルの内容のbytes
+        digest = hashlib.blake2b(parserVersion(), digest_size=20)
+        digest.update(data)
+        return digest.hexdigest()
+
+    def load(self, key, kind):
+        path = os.path.join(self.directory, key + '.' + kind)
+        try:
+            with open(path, 'rb') as f:
+                payload = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        #最近使ったものとして、更新時刻を新しくする
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return payload
+
+    def store(self, key, kind, payload):
+        if len(payload) > self.max_bytes:
+            return
+        path = os.path.join(self.directory, key + '.' + kind)
+        fd, temporary_path = tempfile.mkstemp(prefix=self.temporary_prefix, dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+            os.replace(temporary_path, path)
+        except BaseException:
+            try:
+                os.remove(temporary_path)
+            except OSError:
+                pass
+            raise
+        if self.entry_sizes is None or self.stores_since_scan >= self.rescan_interval:
+            self.rescan()
+        else:
+            #同じキーを書き直したときは、前の大きさを引く
+            self.total_bytes += len(payload) - self.entry_sizes.get(path, 0)
+            self.entry_sizes[path] = len(payload)
+            self.stores_since_scan += 1
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def loadTree(self, key):
+        payload = self.load(key, 'ast')
+        if payload is None:
+            return None
+        try:
+            return loads(payload)
+        except ValueError:
+            #壊れたエントリは、無かったものとして削除する
+            self.hits -= 1
+            self.misses += 1
+            path = os.path.join(self.directory, key + '.ast')
+            self.removeFile(path)
+            if self.entry_sizes is not None and path in self.entry_sizes:
+                self.total_bytes -= self.entry_sizes.pop(path)
+            return None
+
+    def storeTree(self, key, document):
+        self.store(key, 'ast', dumps(document))
+
+    #kindは、parseFile()の木から作ったHTMLなら'html'、convertFile()で逐次変換したHTMLなら'stream.html'。
+    #逐次変換では入れ子のブロックの中の定義が、それより前のリンクに届かないので、別のエントリにする。
+    def loadHTML(self, key, kind='html'):
+        payload = self.load(key, kind)
+        if payload is None:
+            return None
+        return payload.decode('utf-8')
+
+    def storeHTML(self, key, html, kind='html'):
+        self.store(key, kind, html.encode('utf-8'))
+
+    def scanEntries(self):
+        #(更新時刻, 大きさ, パス)のリストを返す。他のプロセスが削除したファイルは無視する。
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.startswith(self.temporary_prefix):
+                if now - stat.st_mtime > self.temporary_lifetime:
+                    self.removeFile(entry.path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def rescan(self):
+        #ディレクトリを走査して、大きさの合計を数え直す
+        entries = self.scanEntries()
+        self.entry_sizes = {path: size for _, size, path in entries}
+        self.total_bytes = sum(self.entry_sizes.values())
+        self.stores_since_scan = 0
+        return entries
+
+    def evict(self):
+        #他のプロセスの書き込みや削除も反映するため、追い出す前に数え直す
+        entries = self.rescan()
+        if self.total_bytes <= self.max_bytes:
+            return
+        limit = self.max_bytes * self.eviction_ratio
+        entries.sort()
+        for _, size, path in entries:
+            if self.total_bytes <= limit:
+                break
+            self.removeFile(path)
+            del self.entry_sizes[path]
+            self.total_bytes -= size
+            self.evictions += 1
+
+    @staticmethod
+    def removeFile(path):
+        #同時に他のプロセスが削除していてもよい
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def info(self):
+        entries = self.scanEntries()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'files': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+            'max_bytes': self.max_bytes,
+        }
+
+def dumps(element):
+    """
+    This function will serialize a parsed element (usually a root) into the
+    compact binary form read by loads().
+    After DUMP_MAGIC comes a blake2b checksum of the rest of the data,
+    which loads() checks before reading anything else.
+    Then comes a string table: the number of strings, their
+    lengths and their UTF-8 text joined in one blob. Then each value is one
+    byte of its kind (DUMP_*) followed by varints: a node is the index of
+    its class in defined_classes, a bit mask of its slots that are set
+    (deleted ones such as rawdata are skipped) and their values, a string
+    is its index in the table, and a dict
+    (such as references, shared by every block) is written once and then
+    referred to by its index.
+    """
+    strings = {}
+    shared = {}
+    body = bytearray()
+    dumpValue(element, body, strings, shared)
+    header = bytearray()
+    writeVarint(header, len(strings))
+    for text in strings:
+        writeVarint(header, len(text))
+    blob = ''.join(strings).encode('utf-8', 'surrogatepass')
+    writeVarint(header, len(blob))
+    checksum = hashlib.blake2b(header, digest_size=DUMP_CHECKSUM_SIZE)
+    checksum.update(blob)
+    checksum.update(body)
+    return b''.join((DUMP_MAGIC, checksum.digest(), header, blob, body))
+
+def writeVarint(out, value):
+    #7ビットずつ、下位から書く。続きがあるバイトは最上位ビットを立てる。
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def dumpValue(value, out, strings, shared):
+    value_class = value.__class__
+    if value_class is str:
+        index = strings.get(value)
+        if index is None:
+            index = strings[value] = len(strings)
+        out.append(DUMP_STRING)
+        writeVarint(out, index)
+    elif value is None:
+        out.append(DUMP_NONE)
+    elif value is True or value is False:
+        out.append(DUMP_TRUE if value else DUMP_FALSE)
+    elif value_class is int:
+        #負の数も小さな正の数になるように、zigzag符号化する
+        out.append(DUMP_INT)
+        writeVarint(out, value * 2 if value >= 0 else -value * 2 - 1)
+    elif value_class is list or value_class is tuple:
+        out.append(DUMP_LIST)
+        writeVarint(out, len(value))
+        for item in value:
+            dumpValue(item, out, strings, shared)
+    elif value_class is dict:
+        entry = shared.get(id(value))
+        if entry is not None:
+            out.append(DUMP_SHARED)
+            writeVarint(out, entry[0])
+            return
+        #idが再利用されないよう、辞書そのものも保持しておく
+        shared[id(value)] = (len(shared), value)
+        out.append(DUMP_DICT)
+        writeVarint(out, len(value))
+        for key, item in value.items():
+            dumpValue(key, out, strings, shared)
+            dumpValue(item, out, strings, shared)
+    elif value_class is array.array:
+        out.append(DUMP_ARRAY)
+        writeVarint(out, len(value))
+        for item in value:
+            writeVarint(out, item * 2 if item >= 0 else -item * 2 - 1)
+    else:
+        code = dump_codes.get(value_class)
+        if code is None:
+            raise TypeError('cannot dump {}'.format(value_class.__name__))
+        #設定されているスロットをビットで示し、その値だけを書く
+        items = []
+        mask = 0
+        for bit, name in enumerate(dump_slots[code]):
+            try:
+                items.append(getattr(value, name))
+            except AttributeError:
+                continue
+            mask |= 1 << bit
+        out.append(DUMP_NODE)
+        writeVarint(out, code)
+        writeVarint(out, mask)
+        for item in items:
+            dumpValue(item, out, strings, shared)
+
+def loads(data):
+    """
+    This function will restore an element serialized by dumps().
+    Inline objects that were frozen are restored as ordinary ones.
+    Data that is truncated or otherwise malformed raises ValueError, and so
+    does data changed after dumps(), which fails the checksum.
+    """
+    try:
+        return readDump(data)
+    except (IndexError, StopIteration, TypeError, UnicodeDecodeError, RecursionError,
+            OverflowError, MemoryError) as error:
+        raise ValueError('corrupt serialized data: {}: {}'.format(type(error).__name__, error)) from error
+
+def readDump(data):
+    #loads()の本体。壊れたデータで起きるIndexErrorなどは、loads()がValueErrorに置き換える。
+    if data[:4] != DUMP_MAGIC:
+        raise ValueError('corrupt serialized data: not serialized by mmparser.dumps()')
+    position = 4 + DUMP_CHECKSUM_SIZE
+    #壊れた値で木を作らないよう、先に全体を確かめる
+    if hashlib.blake2b(memoryview(data)[position:], digest_size=DUMP_CHECKSUM_SIZE).digest() != data[4:position]:
+        raise ValueError('corrupt serialized data: checksum does not match')
+    #文字列のテーブルを読む
+    count, position = readVarintAt(data, position)
+    lengths = []
+    for _ in range(count):
+        length, position = readVarintAt(data, position)
+        lengths.append(length)
+    blob_length, position = readVarintAt(data, position)
+    if position + blob_length > len(data):
+        raise ValueError('corrupt serialized data: truncated string table')
+    blob = bytes(data[position:position + blob_length]).decode('utf-8', 'surrogatepass')
+    strings = []
+    offset = 0
+    for length in lengths:
+        strings.append(blob[offset:offset + length])
+        offset += length
+    if offset != len(blob):
+        raise ValueError('corrupt serialized data: string lengths do not match the table')
+    #以降の値は、1バイトずつ読み進める
+    body = iter(memoryview(data)[position + blob_length:])
+    next_byte = body.__next__
+    shared = []
+
+    def readVarint():
+        byte = next_byte()
+        if byte < 0x80:
+            return byte
+        value = byte & 0x7f
+        shift = 7
+        while True:
+            byte = next_byte()
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def readValue():
+        kind = next_byte()
+        if kind == DUMP_STRING:
+            return strings[readVarint()]
+        if kind == DUMP_NODE:
+            code = readVarint()
+            node_class = defined_classes[code]
+            node = node_class.__new__(node_class)
+            mask = readVarint()
+            for setter in dump_setters[code]:
+                if mask & 1:
+                    setter(node, readValue())
+                mask >>= 1
+                if not mask:
+                    break
+            if mask:
+                raise ValueError('corrupt serialized data: unknown slots of {}'.format(node_class.__name__))
+            return node
+        if kind == DUMP_LIST:
+            return [readValue() for _ in range(readVarint())]
+        if kind == DUMP_NONE:
+            return None
+        if kind == DUMP_SHARED:
+            return shared[readVarint()]
+        if kind == DUMP_DICT:
+            value = {}
+            shared.append(value)
+            for _ in range(readVarint()):
+                key = readValue()
+                value[key] = readValue()
+            return value
+        if kind == DUMP_INT:
+            value = readVarint()
+            return value >> 1 if value & 1 == 0 else -(value >> 1) - 1
+        if kind == DUMP_TRUE:
+            return True
+        if kind == DUMP_FALSE:
+            return False
+        if kind == DUMP_ARRAY:
+            values = array.array('l')
+            for _ in range(readVarint()):
+                value = readVarint()
+                values.append(value >> 1 if value & 1 == 0 else -(value >> 1) - 1)
+            return values
+        raise ValueError('corrupt serialized data: unknown value kind {}'.format(kind))
+
+    value = readValue()
+    for _ in body:
+        raise ValueError('corrupt serialized data: trailing bytes')
+    return value
+
+def readVarintAt(data, position):
+    #data[position]から始まるvarintと、その次の位置を返す
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+class parseCheckpoint:
+    """
+    Position of MarkdownParser.resume() in a document that only grows.
+    A checkpoint is always taken after the last closed top-level block,
+    where the parser state is STATE_BLANK and nothing is buffered, so only
+    the lines after it have to be kept:
+    document (root element of all the lines so far), index (number of lines
+    before the checkpoint), element_count (number of top-level elements of
+    those lines), text_buffer (lines after the checkpoint, whose block may
+    still continue) and file_position (bytes of the file read by
+    resumeFile()).
+    """
+    __slots__ = ('document', 'index', 'element_count', 'text_buffer', 'file_position')
+
+    def __init__(self):
+        self.document = root([])
+        self.index = 0
+        self.element_count = 0
+        self.text_buffer = []
+        self.file_position = 0
+
+class flatDocument:
+    """
+    Flat representation of a parsed document for keeping many documents
+    in memory. Nodes are stored in preorder as array columns:
+    types (node type code), parents (index of the parent node, -1 for the
+    root), starts/ends (span of the node text in buffer) and values
+    (header level, cell alignment or attribute kind).
+    Texts found in the source are not copied; their spans point into it.
+    Other texts (escaped or stripped ones) are appended after the source.
+    """
+    #テキストをsourceの中で探す範囲。見つからなければbufferの末尾に追加する。
+    search_window = 4096
+    #表のセルのalignmentと、valuesに格納する値の対応
+    alignment_codes = {None: 0, 'left': 1, 'center': 2, 'right': 3}
+    alignment_names = (None, 'left', 'center', 'right')
+
+    def __init__(self, source=''):
+        self.types = array.array('B')
+        self.parents = array.array('l')
+        self.starts = array.array('l')
+        self.ends = array.array('l')
+        self.values = array.array('H')
+        self.buffer = source
+        self.source_length = len(source)
+        #sourceの中で、次にテキストを探し始める位置
+        self.cursor = 0
+        #bufferにまだ結合していないテキストと、それを含めたbufferの長さ
+        self.pending_text = []
+        self.text_length = len(source)
+        #0番目のノードは常にroot
+        self.appendNode(FLAT_CLASS_OFFSET + defined_classes.index(root), -1)
+
+    @classmethod
+    def fromTree(cls, element, source=''):
+        """
+        This function will return a flatDocument holding the children of a
+        parsed root element.
+        """
+        document = cls(source)
+        for child in element.parsed_data:
+            document.appendElement(child)
+        return document
+
+    def __len__(self):
+        return len(self.types)
+
+    def storeText(self, text):
+        #テキストの位置(start, end)を返す。
+        if not text:
+            return 0, 0
+        start = self.buffer.find(text, self.cursor, min(self.source_length, self.cursor + len(text) + self.search_window))
+        if start >= 0:
+            self.cursor = start + len(text)
+            return start, self.cursor
+        start = self.text_length
+        self.pending_text.append(text)
+        self.text_length += len(text)
+        return start, self.text_length
+
+    def appendNode(self, node_type, parent, text='', value=0):
+        start, end = self.storeText(text)
+        self.types.append(node_type)
+        self.parents.append(parent)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.values.append(value)
+        return len(self.types) - 1
+
+    def appendElement(self, element, parent=0):
+        """
+        This function will append an element of the tree and its children as
+        nodes under parent. Link ids must already be resolved.
+        """
+        if not isinstance(element, defined_classes):
+            return self.appendNode(NODE_TEXT, parent, element)
+        element_class = getattr(element.__class__, 'unfrozen_class', element.__class__)
+        node_type = FLAT_CLASS_OFFSET + defined_classes.index(element_class)
+        if element_class is headers:
+            return self.appendNode(node_type, parent, element.parsed_data, element.level)
+        if element_class is table:
+            index = self.appendNode(node_type, parent)
+            header = self.appendNode(NODE_TABLE_HEADER, index)
+            for item in element.headers:
+                self.appendNode(NODE_TABLE_HEADER_CELL, header, item)
+            alignments = element.alignments
+            for row, length in enumerate(element.row_lengths):
+                row_index = self.appendNode(NODE_TABLE_ROW, index)
+                for column in range(length):
+                    alignment = alignments[column] if column < len(alignments) else None
+                    self.appendNode(NODE_TABLE_CELL, row_index, element.columns[column][row], self.alignment_codes[alignment])
+            return index
+        if element_class is fencedCodeBlock:
+            #info文字列はノード自身のテキストに格納する
+            index = self.appendNode(node_type, parent, element.info)
+            for line in element.parsed_data:
+                self.appendNode(NODE_TEXT, index, line)
+            return index
+        if element_class is links:
+            index = self.appendNode(node_type, parent, element.title)
+            if element.url:
+                self.appendNode(NODE_ATTRIBUTE, index, element.url)
+            elif element.reference:
+                self.appendNode(NODE_ATTRIBUTE, index, element.reference['url'])
+            return index
+        if element_class is images:
+            index = self.appendNode(node_type, parent, element.title)
+            if element.url:
+                self.appendNode(NODE_ATTRIBUTE, index, element.url)
+            elif element.reference:
+                self.appendNode(NODE_ATTRIBUTE, index, element.reference['url'])
+                #valueが1の属性はalt
+                self.appendNode(NODE_ATTRIBUTE, index, element.reference['optional_title'] or '', 1)
+            return index
+        if isinstance(element.parsed_data, str):
+            return self.appendNode(node_type, parent, element.parsed_data)
+        index = self.appendNode(node_type, parent)
+        for child in element.parsed_data:
+            self.appendElement(child, index)
+        return index
+
+    def getBuffer(self):
+        #追加されたテキストは、必要になった時点でbufferに結合する
+        if self.pending_text:
+            self.buffer = self.buffer + ''.join(self.pending_text)
+            self.pending_text = []
+        return self.buffer
+
+    def getText(self, index):
+        return self.getBuffer()[self.starts[index]:self.ends[index]]
+
+    def getClass(self, index):
+        #クラスを持たない種類のノードはNoneを返す
+        node_type = self.types[index]
+        if node_type < FLAT_CLASS_OFFSET:
+            return None
+        return defined_classes[node_type - FLAT_CLASS_OFFSET]
+
+    def expandToHTML(self):
+        chunks = []
+        self.appendHTML(chunks)
+        return ''.join(chunks)
+
+    def appendHTML(self, chunks):
+        """
+        This function will render the same HTML as expandToHTML() of the
+        tree. Nodes are visited in order with a stack of open nodes, so the
+        tree is never rebuilt.
+        """
+        buffer = self.getBuffer()
+        parents = self.parents
+        stack = []
+        for index in range(len(self.types)):
+            parent = parents[index]
+            while stack and stack[-1] != parent:
+                self.closeNode(stack.pop(), chunks, buffer)
+            self.openNode(index, chunks, buffer)
+            stack.append(index)
+        while stack:
+            self.closeNode(stack.pop(), chunks, buffer)
+
+    def openNode(self, index, chunks, buffer):
+        node_type = self.types[index]
+        text = buffer[self.starts[index]:self.ends[index]]
+        if node_type == NODE_TEXT:
+            chunks.append(text)
+        elif node_type == NODE_TABLE_HEADER or node_type == NODE_TABLE_ROW:
+            chunks.append('<tr>\n')
+        elif node_type == NODE_TABLE_HEADER_CELL:
+            chunks.append('<th>' + text + '</th>\n')
+        elif node_type == NODE_TABLE_CELL:
+            alignment = self.alignment_names[self.values[index]]
+            if alignment:
+                chunks.append('<td align="{}">'.format(alignment) + text + '</td>\n')
+            else:
+                chunks.append('<td>' + text + '</td>\n')
+        elif node_type == NODE_ATTRIBUTE:
+            if self.values[index] == 1:
+                chunks.append(' alt="{}"'.format(text))
+            elif self.getClass(self.parents[index]) is links:
+                chunks.append(' href="{}"'.format(text))
+            else:
+                chunks.append(' src="{}"'.format(text))
+        else:
+            element_class = defined_classes[node_type - FLAT_CLASS_OFFSET]
+            if element_class is headers:
+                chunks.append('<h{}>'.format(self.values[index]) + text + '</h{}>'.format(self.values[index]) + '\n')
+            elif element_class is table:
+                chunks.append('<table>\n')
+            elif element_class is fencedCodeBlock:
+                chunks.append(fencedCodeBlock.startTag(text))
+                chunks.append('\n')
+            elif element_class is links:
+                chunks.append('<a')
+            elif element_class is images:
+                chunks.append('<img')
+            else:
+                chunks.append(element_class.start_tag)
+                chunks.append('\n')
+                chunks.append(text)
+
+    def closeNode(self, index, chunks, buffer):
+        node_type = self.types[index]
+        if node_type == NODE_TABLE_HEADER:
+            chunks.append('\n</tr>\n')
+        elif node_type == NODE_TABLE_ROW:
+            chunks.append('</tr>\n')
+        elif node_type >= FLAT_CLASS_OFFSET:
+            element_class = defined_classes[node_type - FLAT_CLASS_OFFSET]
+            if element_class is table:
+                chunks.append('\n</table>')
+            elif element_class is links:
+                chunks.append('>' + buffer[self.starts[index]:self.ends[index]] + '</a>\n')
+            elif element_class is images:
+                chunks.append('>')
+            elif issubclass(element_class, inlineObject):
+                chunks.append('\n')
+                chunks.append(element_class.end_tag)
+            elif element_class is not headers:
+                chunks.append('\n')
+                chunks.append(element_class.end_tag)
+                chunks.append('\n')
+        #ブロック要素の子要素の後には改行が入る
+        parent = self.parents[index]
+        if parent >= 0 and self.types[parent] in self.block_types:
+            chunks.append('\n')
+
+class inlineCache:
+    """
+    LRU cache of parseInlineElements() results keyed by line text.
+    The cached inline objects are frozen, so the same objects can be shared
+    by every document parsed in this process. The entries and counters are
+    guarded by a lock, so the cache can be used from many threads.
+    """
+    def __init__(self, maxsize=4096):
+        self.lock = threading.Lock()
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, text):
+        #キャッシュに無ければNoneを返す。呼び出し側が追加できるように、リストは毎回新しく作る。
+        with self.lock:
+            parsed_text = self.entries.get(text)
+            if parsed_text is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(text)
+        return list(parsed_text)
+
+    def put(self, text, parsed_text):
+        #freeze()するのは呼び出し側のスレッドが作ったばかりのオブジェクトなので、ロックの外で行う
+        for item in parsed_text:
+            if isinstance(item, inlineObject):
+                item.freeze()
+        with self.lock:
+            self.entries[text] = tuple(parsed_text)
+            self.entries.move_to_end(text)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def info(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+            }
+
+#インライン要素のキャッシュ。enableInlineCache()で有効にする。
+inline_cache = None
+
+def enableInlineCache(maxsize=4096):
+    """
+    This function will enable the inline cache shared by all MarkdownParser
+    instances and return it. Hit, miss and eviction counts are available
+    from its info() method.
+    """
+    global inline_cache
+    inline_cache = inlineCache(maxsize)
+    return inline_cache
+
+def disableInlineCache():
+    global inline_cache
+    inline_cache = None
+
+class renderCache:
+    """
+    LRU cache of the HTML of top-level elements keyed by their fingerprint
+    (see MarkdownParser.iterSteps()). Unchanged blocks are rendered once
+    across versions of a document and across documents sharing sections.
+    The size is bounded by the total length of the cached HTML.
+    """
+    def __init__(self, max_chars=16 * 1024 * 1024):
+        self.lock = threading.Lock()
+        self.max_chars = max_chars
+        self.entries = OrderedDict()
+        self.chars = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def render(self, element):
+        #要素のHTMLを返す。fingerprintを持つ要素は、キャッシュに無ければ描画して追加する。
+        fingerprint = getattr(element, 'fingerprint', None)
+        if fingerprint is None:
+            return element.expandToHTML()
+        with self.lock:
+            html = self.entries.get(fingerprint)
+            if html is not None:
+                self.hits += 1
+                self.entries.move_to_end(fingerprint)
+                return html
+            self.misses += 1
+        html = element.expandToHTML()
+        self.put(fingerprint, html)
+        return html
+
+    def put(self, fingerprint, html):
+        if len(html) > self.max_chars:
+            return
+        with self.lock:
+            if fingerprint in self.entries:
+                return
+            self.entries[fingerprint] = html
+            self.chars += len(html)
+            while self.chars > self.max_chars:
+                _, evicted = self.entries.popitem(last=False)
+                self.chars -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.chars = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def info(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'size': len(self.entries),
+                'chars': self.chars,
+                'max_chars': self.max_chars,
+            }
+
+#トップレベルの要素の描画結果のキャッシュ。enableRenderCache()で有効にする。
+render_cache = None
+
+def enableRenderCache(max_chars=16 * 1024 * 1024):
+    """
+    This function will enable the render cache shared by all documents and
+    return it. Only documents parsed while it is enabled have fingerprints.
+    Hit rate and other counts are available from its info() method.
+    """
+    global render_cache
+    render_cache = renderCache(max_chars)
+    return render_cache
+
+def disableRenderCache():
+    global render_cache
+    render_cache = None
+
+def isPunctuation(char):
+    return char in string.punctuation or unicodedata.category(char).startswith('P')
 
 class blockObject:
+    #referencesはリンクのid情報の辞書。文書のrootが持ち、子要素はその参照を共有する。
+    #index, text_buffer, stateは解析中にのみ使う。
+    #open_blockは解析中のリストか引用。その行はtext_bufferに溜めずに、直接open_blockへ渡す。
+    #fingerprintは、描画結果のキャッシュが有効な間に解析されたトップレベルの要素だけが持つ。
+    __slots__ = ('rawdata', 'parsed_data', 'references', 'index', 'text_buffer', 'state',
+                 'open_block', 'fingerprint')
+    #タグの文字列はクラスごとに共有する
+    start_tag = ''
+    end_tag = ''
+
     def __init__(self, listed_data):
         self.rawdata = listed_data
         self.parsed_data = []
-        self.inline_reg = [
-            {'rule':inline_rules['LineBreak']      , 'class':lineBreak      },
-            {'rule':inline_rules['BoldFont']       , 'class':boldFont       },
-            {'rule':inline_rules['EmphasizedFont'] , 'class':emphasizedFont },
-            {'rule':inline_rules['DeletedFont']    , 'class':deletedFont    },
-            {'rule':inline_rules['InlineCode']     , 'class':inlineCode     },
-            {'rule':inline_rules['Images']         , 'class':images         },
-            {'rule':inline_rules['Links']          , 'class':links          },
-        ]
-        self.reset()
-        
+        self.references = None
+
     def reset(self):
         self.index = 0
         self.text_buffer = []
-        self.start_tag = ''
-        self.end_tag = ''
+        self.state = STATE_BLANK
+        self.open_block = None
 
     def parse(self):
         if len(self.rawdata) == 0:
             return
+        self.startFeed()
+        for _ in self.iterFeed(self.rawdata):
+            pass
+        self.closeFeed()
+        del self.rawdata
+        self.releaseFeed()
+        return
 
-        previous_line_type = 'Blank'
-        while self.index < len(self.rawdata):
-            if previous_line_type == 'Blank':
-                self.text_buffer = []
-                previous_line_type = self.parseFirstTime(self.rawdata[self.index])
-                self.index += 1
-                continue
-
-            if previous_line_type == 'Normal':
-                previous_line_type = self.parseNormalBlock(self.rawdata[self.index])
-                self.index += 1
-                continue
-
-            if previous_line_type == 'Table':
-                previous_line_type = self.parseTableBlock(self.rawdata[self.index])
-                self.index += 1
-                continue
-
-            if previous_line_type == 'BlockQuote':
-                previous_line_type = self.parseBlockQuote(self.rawdata[self.index])
-                self.index += 1
-                continue
-
-            if previous_line_type == 'TaggedBlock':
-                previous_line_type = self.parseTaggedBlock(self.rawdata[self.index])
-                self.index += 1
-                continue
-
-            if previous_line_type == 'CodeBlock':
-                previous_line_type = self.parseCodeBlock(self.rawdata[self.index])
-                self.index += 1
-                continue
+    def startFeed(self):
+        #行を1行ずつ渡して解析する準備をする。
+        self.reset()
 
-            if previous_line_type == 'ulLists':
-                previous_line_type = self.parseUlLists(self.rawdata[self.index])
-                self.index += 1
-                continue
+    def feedLine(self, text):
+        #1行を処理する。ブロックが終わった時点で、その要素がparsed_dataに追加される。
+        self.state = self.state_handlers[self.state](self, text)
+        self.index += 1
 
-            if previous_line_type == 'olLists':
-                previous_line_type = self.parseOlLists(self.rawdata[self.index])
-                self.index += 1
-                continue
+    def iterFeed(self, lines, start=0):
+        """
+        This function will feed lines with feedLine() and yield after each
+        step. When lines is a list, feeding starts at lines[start] and the
+        body of a fenced code block is taken up to its closing fence in one
+        slice (see feedFencedLines()).
+        """
+        if not isinstance(lines, list):
+            for line in lines:
+                self.feedLine(line)
+                yield
+            return
+        position = start
+        while position < len(lines):
+            self.feedLine(lines[position])
+            position += 1
+            if self.state == STATE_FENCED_CODE:
+                position = self.feedFencedLines(lines, position)
+            yield
+
+    def closeFeed(self):
+        # 解析中のリストや引用、text_bufferに残ってる場合の処理
+        if self.state == STATE_NORMAL and len(self.text_buffer) > 1:
+            #段落の続きの行で終わった場合は、行をまとめて解析していたときと同じく、空行を足さずにその行で閉じる
+            self.closeNormalBlock()
+        elif self.state != STATE_BLANK and (len(self.text_buffer) > 0 or self.open_block is not None):
+            closer = self.state_closers.get(self.state)
+            if closer:
+                closer(self)
+        self.state = STATE_BLANK
+        self.text_buffer = []
 
-            #ブロック要素として処理ができないとき、通常文として処理する。
-            if previous_line_type == -1:
-                previous_line_type = self.parseNormalBlock(self.rawdata[self.index])
-                self.index += 1
-                continue
+    def releaseFeed(self):
+        #解析が終わったら、解析用の属性は不要なので解放する
+        del self.index, self.text_buffer, self.state, self.open_block
 
-            
-        # text_bufferに残ってる場合の処理
-        if len(self.text_buffer) > 0:
-            if previous_line_type == 'Normal':
-                self.parseNormalBlock('')
-            if previous_line_type == 'Table':
-                self.parseTableBlock('')
-            if previous_line_type == 'BlockQuote':
-                self.parseBlockQuote('')
-            if previous_line_type == 'CodeBlock':
-                self.parseCodeBlock('')
-            if previous_line_type == 'ulLists':
-                #空白、箇条書き以外の文字列を渡す
-                self.parseUlLists('a')
-            if previous_line_type == 'olLists':
-                self.parseOlLists('a')
-        del self.rawdata
-        return
+    def appendBlock(self, block_class, data):
+        #子要素を生成してparseし、parsed_dataに追加する。
+        instance = block_class(data)
+        instance.references = self.references
+        instance.parse()
+        self.parsed_data.append(instance)
+        return instance
 
     #####################################################
     # 以下、ブロック要素のparse関数。                      #
@@ -241,254 +1773,592 @@ class blockObject:
     # 関数内でオブジェクトを生成したらparse()を実行すること。#
     #####################################################
 
+    def parseBlankLine(self, text):
+        #前のブロックが終わった状態から、新しいブロックを始める。
+        self.text_buffer = []
+        return self.parseFirstTime(text)
+
+    @staticmethod
+    def matchFirstTimeRule(text):
+        #行頭の空白以外の最初の文字から、合致する可能性のあるblock要素のルールだけを試す。
+        #合致したfirst_time_rulesの名前を返す。
+        stripped_text = text.lstrip()
+        indent = len(text) - len(stripped_text)
+        candidates = first_char_index.get(stripped_text[:1], default_candidates)
+        for name, rule, first_chars, min_indent, max_indent, required in candidates:
+            if indent < min_indent or (max_indent is not None and indent > max_indent):
+                continue
+            if required and required not in text:
+                continue
+            if rule.match(text):
+                return name
+        return None
+
     def parseFirstTime(self, text):
-        
-        #block要素のルールに合致するかを判断する。
-        if tagged_line.match(text):
-            instance = taggedBlock([text])
-            instance.parse()
-            self.parsed_data.append(instance)
-            return 'Blank'
-        for rule in block_rules.keys():
-            if block_rules[rule].match(text):
-                self.text_buffer.append(text)
-                #次の行の処理のために、現在の行の種類を保存する
-                return rule
-        if block_quote.match(text):
-            #一番左の'>'を空白と置き換え、さらに左端の空白を切り詰める。
-            stripped_text = re.sub(r'\s*(\>\s|\>)', '', text, 1)
-            self.text_buffer.append(stripped_text)
-            return 'BlockQuote'
-        if header_block.match(text):
-            instance = headers(text)
-            instance.parse()
-            self.parsed_data.append(instance)
-            return 'Blank'
-        if horizontal_rule.match(text):
-            self.parsed_data.append(horizontalRule([]))
-            return 'Blank'
-        if definition_block.match(text):
-            self.parseDefinitionBlock(text)
-            return 'Blank'
+        name = self.matchFirstTimeRule(text)
+        if name is not None:
+            if name == 'TaggedLine':
+                self.appendBlock(taggedBlock, [text])
+                return STATE_BLANK
+            if name == 'BlockQuote':
+                #引用を開始し、以降の行は引用が閉じるまでopen_blockへ渡す。
+                self.open_block = blockQuote([])
+                self.open_block.references = self.references
+                self.open_block.startFeed()
+                self.feedQuoteLine(text)
+                return STATE_BLOCK_QUOTE
+            if name == 'Header':
+                self.appendBlock(headers, text)
+                return STATE_BLANK
+            if name == 'HorizontalRule':
+                self.parsed_data.append(horizontalRule([]))
+                return STATE_BLANK
+            if name == 'Definition':
+                self.parseDefinitionBlock(text)
+                return STATE_BLANK
+            if name == 'ulLists' or name == 'olLists':
+                self.openList(ulLists if name == 'ulLists' else olLists, text)
+                return block_states[name]
+            if name == 'FencedCode':
+                #閉じるフェンスまでの行は、解析せずにopen_blockへ溜める。
+                self.openFencedCode(text)
+                return STATE_FENCED_CODE
+            if name == 'CodeBlock':
+                #行頭の空白は、ブロックの開始時に1度だけ取り除く
+                self.text_buffer.append(text.lstrip())
+                return STATE_CODE_BLOCK
+            #block_rulesのいずれかに合致した場合
+            self.text_buffer.append(text)
+            #次の行の処理のために、現在の行の種類を状態として返す
+            return block_states[name]
         #block要素のいずれにも合致しなかった場合
-        if not blank_line.match(text):
+        if text.strip():
             self.text_buffer.append(text)
-            return 'Normal'
+            return STATE_NORMAL
         else:
-            return 'Blank'
+            return STATE_BLANK
         
 
     def parseInlineElements(self, text):
-        
-        parsed_text = []
-        for dit in self.inline_reg:
-            if dit['rule'].search(text):
-                element = dit['rule'].search(text).group()
-                instance = dit['class'](element)
+        """
+        This function will return the inline elements of a line.
+        If the inline cache is enabled, the result is shared between lines
+        having the same text and its inline objects are read-only.
+        """
+        cache = inline_cache
+        if cache is None:
+            return self.tokenizeInlineElements(text)
+        parsed_text = cache.get(text)
+        if parsed_text is None:
+            parsed_text = self.tokenizeInlineElements(text)
+            cache.put(text, parsed_text)
+        return parsed_text
+
+    def tokenizeInlineElements(self, text):
+        """
+        This function will tokenize a line with one sweep of inline_master.
+        Each matched span becomes an instance of the class for its rule.
+        Runs of '*', '_' and '~' are resolved afterwards by processEmphasis().
+        """
+        #トークンは双方向リストでつなぎ、強調記号はさらにスタックでつなぐ
+        head = tail = inlineToken(None)
+        delimiters = []
+        #text_startはまだ要素に変換していない文字列の先頭
+        text_start = 0
+        for matched in inline_master.finditer(text):
+            if text_start < matched.start():
+                tail = tail.append(inlineToken(text[text_start:matched.start()]))
+            if matched.lastgroup == 'Delimiter':
+                token = self.createDelimiterRun(text, matched.start(), matched.end())
+                delimiters.append(token)
+            else:
+                instance = inline_classes[matched.lastgroup](matched.group())
                 instance.shapeData()
                 #（elementsを整形する処理は個別のクラスで実装）
-                devided_text = re.sub(dit['rule'], '_splitter_', text, 1).split('_splitter_')
-                #before_element and after_element should be list.
-                before_element = self.parseInlineElements(devided_text[0])
-                after_element = self.parseInlineElements(devided_text[1])
-                for item in before_element:
-                    if item != '':
-                        parsed_text.append(item)
-                parsed_text.append(instance)
-                for item in after_element:
-                    if item != '':
-                        parsed_text.append(item)
-                return parsed_text
-        #if all inline rules didn't match with text
-        return [text]
+                token = inlineToken(instance)
+            tail = tail.append(token)
+            text_start = matched.end()
+        if text_start < len(text):
+            tail.append(inlineToken(text[text_start:]))
+        self.processEmphasis(delimiters)
+        parsed_text = self.collectTokens(head.next, None)
+        #インライン要素が無い行はそのまま返す。
+        if len(parsed_text) == 0:
+            parsed_text.append(text)
+        return parsed_text
 
     def parseNormalBlock(self, text):
         #次の文が---等だった場合、前の要素がh1ヘッダになる
         if header_line_h1.match(text):
-            instance = headers(self.text_buffer[0], level=1)
-            instance.parse()
-            self.parsed_data.append(instance)
-            #次の文の処理は振り出しに戻したいので'Blank'を返す
-            return 'Blank'
+            self.parsed_data.append(headers(self.text_buffer[0], level=1))
+            #次の文の処理は振り出しに戻したいのでSTATE_BLANKを返す
+            return STATE_BLANK
         if header_line_h2.match(text):
-            instance = headers(self.text_buffer[0], level=2)
-            instance.parse()
-            self.parsed_data.append(instance)
-            #次の文の処理は振り出しに戻したいので'Blank'を返す
-            return 'Blank'
-        if blank_line.match(text) or self.index >= len(self.rawdata) - 1:
+            self.parsed_data.append(headers(self.text_buffer[0], level=2))
+            #次の文の処理は振り出しに戻したいのでSTATE_BLANKを返す
+            return STATE_BLANK
+        if blank_line.match(text):
             self.text_buffer.append(text)
-            for line in self.text_buffer:
-                parsed_line = self.parseInlineElements(line)
-                for item in parsed_line:
-                    self.parsed_data.append(item)
-            return 'Blank'
+            self.closeNormalBlock()
+            return STATE_BLANK
         else:
             self.text_buffer.append(text)
-            return 'Normal'
+            return STATE_NORMAL
+
+    def closeNormalBlock(self):
+        for line in self.text_buffer:
+            parsed_line = self.parseInlineElements(line)
+            for item in parsed_line:
+                self.parsed_data.append(item)
 
     def parseTableBlock(self, text):
         if block_rules['Table'].match(text):
             self.text_buffer.append(text)
-            return 'Table'
-        elif blank_line.match(text) or self.index >= len(self.rawdata) - 1:
+            return STATE_TABLE
+        elif blank_line.match(text):
             self.text_buffer.append(text)
-            instance = table(self.text_buffer)
-            instance.parse()
-            self.parsed_data.append(instance)
-            return 'Blank'
+            self.appendBlock(table, self.text_buffer)
+            return STATE_BLANK
         else:
-            return -1
+            #表の後に続く行は通常文として処理する
+            return STATE_NORMAL
 
     def parseBlockQuote(self, text):
-        if block_quote.match(text):
-            #一番左の'>'を空白と置き換え、さらに左端の空白を切り詰める。
-            stripped_text = re.sub(r'\s*(\>\s|\>)', '', text, 1)
-            self.text_buffer.append(stripped_text)
-            return 'BlockQuote'
-        if blank_line.match(text) or self.index >= len(self.rawdata) - 1:
+        if blank_line.match(text):
             #空行でブロックの終わりを検知する
-            stripped_text = text.replace('>', '', 1)
-            self.text_buffer.append(stripped_text)
-            instance = blockQuote(self.text_buffer)
-            instance.parse()
-            self.parsed_data.append(instance)
-            return 'Blank'
-        else:
-            self.text_buffer.append(text)
-            return 'BlockQuote'
+            self.open_block.feedLine(text)
+            self.open_block.closeFeed()
+            self.open_block.releaseFeed()
+            self.parsed_data.append(self.open_block)
+            self.open_block = None
+            return STATE_BLANK
+        self.feedQuoteLine(text)
+        return STATE_BLOCK_QUOTE
+
+    def feedQuoteLine(self, text):
+        """
+        This function will feed a line of a blockquote to the innermost open
+        blockquote it belongs to. The '>' markers are counted along the chain
+        of open nested blockquotes, and only the innermost one gets the rest
+        of the line, so the line is not stripped at every level.
+        A line without a marker continues the innermost blockquote as it is.
+        """
+        quote = self.open_block
+        matched = quote_marker.match(text)
+        position = matched.end() if matched else 0
+        #入れ子の引用が解析中の間は内側へ進む。空行はその階層の引用を閉じるので、そこで止まる。
+        while quote.state == STATE_BLOCK_QUOTE:
+            matched = quote_marker.match(text, position)
+            if matched:
+                position = matched.end()
+            elif blank_line.match(text, position):
+                break
+            else:
+                #記号の無い行は、最も内側の引用の続きになる
+                while quote.state == STATE_BLOCK_QUOTE:
+                    quote.index += 1
+                    quote = quote.open_block
+                break
+            quote.index += 1
+            quote = quote.open_block
+        quote.feedLine(text[position:])
 
     def parseTaggedBlock(self, text):
         if block_rules['TaggedBlockEnd'].match(text):
-            instance = taggedBlock(self.text_buffer)
-            instance.parse()
-            self.parsed_data.append(instance)
-            return 'Blank'
+            self.appendBlock(taggedBlock, self.text_buffer)
+            return STATE_BLANK
         else:
             self.text_buffer.append(text)
-            return 'TaggedBlock'
+            return STATE_TAGGED_BLOCK
 
     def parseCodeBlock(self, text):
-        #まず、parseFirstTime()で処理されていない、text_bufferの1要素目の先頭の空白を取り除く。
-        self.text_buffer[0] = self.text_buffer[0].lstrip()
         if block_rules['CodeBlock'].match(text):
             stripped_text = text.lstrip()
             self.text_buffer.append(stripped_text)
-            return 'CodeBlock'
-        elif blank_line.match(text) or self.index >= len(self.rawdata) - 1:
+            return STATE_CODE_BLOCK
+        elif blank_line.match(text):
             stripped_text = text.lstrip()
             self.text_buffer.append(stripped_text)
-            instance = codeBlock(self.text_buffer)
-            instance.parse()
-            self.parsed_data.append(instance)
-            return 'Blank'
+            self.appendBlock(codeBlock, self.text_buffer)
+            return STATE_BLANK
         else:
             self.text_buffer.append(text)
-            return 'CodeBlock'
-
-    def parseUlLists(self, text):
+            return STATE_CODE_BLOCK
+
+    def parseFencedCode(self, text):
+        #閉じるフェンスは正規表現を使わずに直接調べる。それ以外の行はそのまま本文になる。
+        if fencedCodeBlock.isClosingFence(text, self.open_block.fence):
+            self.closeFencedCode()
+            return STATE_BLANK
+        self.open_block.appendLines([text])
+        return STATE_FENCED_CODE
+
+    def openFencedCode(self, text):
+        match = fenced_code.match(text)
+        self.open_block = fencedCodeBlock([])
+        self.open_block.references = self.references
+        self.open_block.fence = match.group('fence')
+        self.open_block.info = match.group('info')
+        self.open_block.indent = self.countIndent(text)
+
+    def feedFencedLines(self, lines, position):
+        """
+        This function will find the closing fence of the open fenced code
+        block in lines, starting at position, and take the lines before it
+        as the body in one slice. It returns the position after the closing
+        fence (len(lines) if the block is still open).
+        """
+        end = self.open_block.findClosingFence(lines, position)
+        self.open_block.appendLines(lines[position:end])
+        self.index += end - position
+        if end == len(lines):
+            return end
+        self.closeFencedCode()
+        self.state = STATE_BLANK
+        self.index += 1
+        return end + 1
+
+    def closeFencedCode(self):
+        self.open_block.parse()
+        self.parsed_data.append(self.open_block)
+        self.open_block = None
+
+    def parseLists(self, text):
+        #各行のインデントと種類は1度だけ調べ、入れ子のリストにもそのまま渡す。
+        indent, column = self.measureIndent(text)
+        return self.continueList(text, indent, column, self.classifyListLine(text))
+
+    def continueList(self, text, indent, column, kind):
         #現在のリストの基準となるインデントを元に、各行が入れ子なのか否かを判断する。
-        base_indent = self.countIndent(self.text_buffer[0])
-        current_line_indent = self.countIndent(text)
+        #同じ種類のリストの行と空行は、常に現在のリストに含める。
+        #別種のリストの行とそれ以外の行は、インデントがある場合のみ前のアイテムの続きだと考える。
+        open_block = self.open_block
+        if kind != open_block.own_kind and kind != LINE_BLANK and indent < open_block.base_indent + 2:
+            return self.closeLists(text)
+        open_block.feedListLine(text, 0, indent, column, kind)
+        return self.state
+
+    @staticmethod
+    def classifyListLine(text):
         if block_rules['ulLists'].match(text):
-            self.text_buffer.append(text)
-            return 'ulLists'
-        elif block_rules['olLists'].match(text):
-            #入れ子のときのみ、現在の行をulListsに含める。
-            if current_line_indent >= base_indent + 2:
-                self.text_buffer.append(text)
-                return 'ulLists'
-            else:
-                instance = ulLists(self.text_buffer)
-                instance.parse()
-                self.parsed_data.append(instance)
-                #現在の行を処理し直す
-                self.index -= 1
-                return 'Blank'
-        elif blank_line.match(text):
-            self.text_buffer.append(text)
-            return 'ulLists'
-        elif self.index >= len(self.rawdata) - 1:
-            instance = ulLists(self.text_buffer)
-            instance.parse()
-            self.parsed_data.append(instance)
-        else:
-            if current_line_indent >= base_indent + 2:
-                #インデントがある場合、前のアイテムの続きだと考える
-                self.text_buffer.append(text)
-                return 'ulLists'
-            else:
-                instance = ulLists(self.text_buffer)
-                instance.parse()
-                self.parsed_data.append(instance)
-                #現在の行を処理し直す
-                self.index -= 1
-                return 'Blank'
-            
-
-    def parseOlLists(self, text):
-        #現在のリストの基準となるインデントを元に、各行が入れ子なのか否かを判断する。
-        base_indent = self.countIndent(self.text_buffer[0])
-        current_line_indent = self.countIndent(text)
+            return LINE_UL
         if block_rules['olLists'].match(text):
-            self.text_buffer.append(text)
-            return 'olLists'
-        elif block_rules['ulLists'].match(text):
-            #入れ子のときのみ、現在の行をulListsに含める。
-            if current_line_indent >= base_indent + 2:
-                self.text_buffer.append(text)
-                return 'olLists'
-            else:
-                instance = olLists(self.text_buffer)
-                instance.parse()
-                self.parsed_data.append(instance)
-                #現在の行を処理し直す
-                self.index -= 1
-                return 'Blank'
-        elif blank_line.match(text):
-            self.text_buffer.append(text)
-            return 'olLists'
-        elif self.index >= len(self.rawdata) - 1:
-            instance = olLists(self.text_buffer)
-            instance.parse()
-            self.parsed_data.append(instance)
-        else:
-            #
-            if current_line_indent >= base_indent + 2:
-                #インデントがある場合、前のアイテムの続きだと考える
-                self.text_buffer.append(text)
-                return 'olLists'
-            else:
-                instance = olLists(self.text_buffer)
-                instance.parse()
-                self.parsed_data.append(instance)
-                #現在の行を処理し直す
-                self.index -= 1
-                return 'Blank'
+            return LINE_OL
+        if blank_line.match(text):
+            return LINE_BLANK
+        return LINE_TEXT
+
+    def openList(self, list_class, text):
+        #リストを開始し、以降の行はリストが閉じるまでopen_blockへ渡す。
+        indent, column = self.measureIndent(text)
+        self.open_block = list_class([])
+        self.open_block.references = self.references
+        self.open_block.startList(indent)
+        self.open_block.feedListLine(text, 0, indent, column, list_class.own_kind)
+
+    def closeList(self):
+        self.open_block.closeList()
+        self.parsed_data.append(self.open_block)
+        self.open_block = None
+
+    def closeLists(self, text):
+        self.closeList()
+        #現在の行は、新しいブロックの先頭として処理し直す
+        return self.parseBlankLine(text)
+
+    #状態の値をインデックスとする処理関数の表。各関数は現在の行を処理し、次の行の状態を返す。
+    #全てのインスタンスで共有する。
+    state_handlers = (
+        parseBlankLine,    # STATE_BLANK
+        parseNormalBlock,  # STATE_NORMAL
+        parseTableBlock,   # STATE_TABLE
+        parseBlockQuote,   # STATE_BLOCK_QUOTE
+        parseTaggedBlock,  # STATE_TAGGED_BLOCK
+        parseCodeBlock,    # STATE_CODE_BLOCK
+        parseLists,        # STATE_UL_LISTS
+        parseLists,        # STATE_OL_LISTS
+        parseFencedCode,   # STATE_FENCED_CODE
+    )
+    #文書の終わりで、処理中のブロックを確定させる関数の表
+    state_closers = {
+        STATE_NORMAL      : lambda self: self.parseNormalBlock(''),
+        STATE_TABLE       : lambda self: self.parseTableBlock(''),
+        STATE_BLOCK_QUOTE : lambda self: self.parseBlockQuote(''),
+        STATE_UL_LISTS    : lambda self: self.closeList(),
+        STATE_OL_LISTS    : lambda self: self.closeList(),
+        STATE_CODE_BLOCK  : lambda self: self.parseCodeBlock(''),
+        STATE_FENCED_CODE : lambda self: self.closeFencedCode(),
+    }
+
+    @classmethod
+    def scanState(cls, state, text, base_indent):
+        """
+        This function will return the state after text and the base indent of
+        the current list (the opening fence for a fenced code block),
+        following the same transitions as the parse functions above without
+        building any element.
+        It is used to find lines where a document can be split.
+        """
+        if state == STATE_BLANK:
+            name = cls.matchFirstTimeRule(text)
+            if name is None:
+                return (STATE_NORMAL if text.strip() else STATE_BLANK), 0
+            if name == 'FencedCode':
+                return STATE_FENCED_CODE, fenced_code.match(text).group('fence')
+            if name in block_states:
+                return block_states[name], cls.countIndent(text)
+            if name == 'BlockQuote':
+                return STATE_BLOCK_QUOTE, 0
+            return STATE_BLANK, 0
+        if state == STATE_NORMAL:
+            if header_line_h1.match(text) or header_line_h2.match(text) or blank_line.match(text):
+                return STATE_BLANK, 0
+            return STATE_NORMAL, 0
+        if state == STATE_TABLE:
+            if block_rules['Table'].match(text):
+                return STATE_TABLE, 0
+            return (STATE_BLANK if blank_line.match(text) else STATE_NORMAL), 0
+        if state == STATE_TAGGED_BLOCK:
+            if block_rules['TaggedBlockEnd'].match(text):
+                return STATE_BLANK, 0
+            return STATE_TAGGED_BLOCK, 0
+        if state == STATE_FENCED_CODE:
+            if fencedCodeBlock.isClosingFence(text, base_indent):
+                return STATE_BLANK, 0
+            return state, base_indent
+        if state in (STATE_BLOCK_QUOTE, STATE_CODE_BLOCK):
+            if blank_line.match(text) and not (state == STATE_CODE_BLOCK and block_rules['CodeBlock'].match(text)):
+                return STATE_BLANK, 0
+            return state, 0
+        #リストの場合
+        own_rule = 'ulLists' if state == STATE_UL_LISTS else 'olLists'
+        if block_rules[own_rule].match(text) or blank_line.match(text):
+            return state, base_indent
+        if cls.countIndent(text) >= base_indent + 2:
+            return state, base_indent
+        return cls.scanState(STATE_BLANK, text, 0)
 
     def expandToHTML(self):
-        expanded_text = ""
+        #HTMLの断片をリストに集め、最後に1度だけ結合する。
+        chunks = []
+        self.appendHTML(chunks)
+        return ''.join(chunks)
+
+    def appendHTML(self, chunks):
+        chunks.append(self.start_tag)
+        chunks.append('\n')
         for element in self.parsed_data:
             if isinstance(element, defined_classes):
-                expanded_text += element.expandToHTML() + '\n'
+                element.appendHTML(chunks)
+            else:
+                chunks.append(element)
+            chunks.append('\n')
+        chunks.append('\n')
+        chunks.append(self.end_tag)
+        chunks.append('\n')
+
+    def resolveReferences(self, references):
+        #子要素のリンクのidを解決する。要素を置き換えた自分自身を返す。
+        self.updateReferences(references)
+        return self
+
+    def updateReferences(self, references):
+        #子要素のリンクのidを解決し、置き換えた要素があればTrueを返す。
+        changed = False
+        parsed_data = self.parsed_data
+        if isinstance(parsed_data, list):
+            for index, element in enumerate(parsed_data):
+                if isinstance(element, blockObject):
+                    changed = element.updateReferences(references) or changed
+                elif isinstance(element, defined_classes):
+                    resolved = element.resolveReferences(references)
+                    if resolved is not element:
+                        parsed_data[index] = resolved
+                        changed = True
+        return changed
+
+    def writeHTML(self, sink):
+        #expandToHTML()と同じHTMLを、要素ごとにsinkへ書き出す。
+        self.writeElements(self.parsed_data, sink)
+
+    def writeElements(self, elements, sink):
+        sink.write(self.start_tag + '\n')
+        cache = render_cache
+        for element in elements:
+            if cache is not None and isinstance(element, blockObject):
+                sink.write(cache.render(element) + '\n')
+            elif isinstance(element, table):
+                #大きな表も、行ごとに書き出す
+                element.writeHTML(sink)
+                sink.write('\n')
+            elif isinstance(element, defined_classes):
+                chunks = []
+                element.appendHTML(chunks)
+                chunks.append('\n')
+                sink.write(''.join(chunks))
             else:
-                expanded_text += element + '\n'
-        return self.start_tag + '\n' + expanded_text + '\n' + self.end_tag + '\n'
+                sink.write(element + '\n')
+        sink.write('\n' + self.end_tag + '\n')
+
+    @staticmethod
+    def createDelimiterRun(text, start, end):
+        #前後の文字から、記号の連続が開き・閉じになれるかを判断する(left/right-flanking)。
+        char = text[start]
+        previous_char = text[start - 1] if start > 0 else ' '
+        next_char = text[end] if end < len(text) else ' '
+        previous_space = previous_char.isspace()
+        next_space = next_char.isspace()
+        previous_punct = isPunctuation(previous_char)
+        next_punct = isPunctuation(next_char)
+        left_flanking = (not next_space) and (not next_punct or previous_space or previous_punct)
+        right_flanking = (not previous_space) and (not previous_punct or next_space or next_punct)
+        if char == '_':
+            can_open = left_flanking and (not right_flanking or previous_punct)
+            can_close = right_flanking and (not left_flanking or next_punct)
+        else:
+            can_open = left_flanking
+            can_close = right_flanking
+        return delimiterRun(char, end - start, can_open, can_close)
 
+    @staticmethod
+    def processEmphasis(delimiters):
+        """
+        This function will match opening and closing delimiter runs
+        like the "process emphasis" procedure of CommonMark.
+        Matched runs are replaced by boldFont, emphasizedFont or deletedFont
+        whose parsed_data are the tokens between them.
+        """
+        #スタックを双方向リストにする
+        previous = None
+        for delimiter in delimiters:
+            delimiter.previous_delimiter = previous
+            if previous:
+                previous.next_delimiter = delimiter
+            previous = delimiter
+        #一度探索して見つからなかった範囲は、同じ種類の閉じ記号では再探索しない
+        openers_bottom = {}
+        closer = delimiters[0] if delimiters else None
+        while closer:
+            if not closer.can_close:
+                closer = closer.next_delimiter
+                continue
+            bottom_key = (closer.char, closer.can_open, closer.original_length % 3)
+            bottom = openers_bottom.get(bottom_key)
+            opener = closer.previous_delimiter
+            while opener is not None and opener is not bottom:
+                if opener.char == closer.char and opener.can_open:
+                    if closer.char == '~':
+                        if opener.length >= 2 and closer.length >= 2:
+                            break
+                    elif not ((opener.can_close or closer.can_open)
+                              and closer.original_length % 3 != 0
+                              and (opener.original_length + closer.original_length) % 3 == 0):
+                        break
+                opener = opener.previous_delimiter
+            if opener is None or opener is bottom:
+                #対応する開き記号が無い
+                openers_bottom[bottom_key] = closer.previous_delimiter
+                next_closer = closer.next_delimiter
+                if not closer.can_open:
+                    closer.removeDelimiter()
+                closer = next_closer
+                continue
+
+            if closer.char == '~':
+                used = 2
+                instance = deletedFont(blockObject.collectTokens(opener.next, closer))
+            elif opener.length >= 2 and closer.length >= 2:
+                used = 2
+                instance = boldFont(blockObject.collectTokens(opener.next, closer))
+            else:
+                used = 1
+                instance = emphasizedFont(blockObject.collectTokens(opener.next, closer))
+            opener.length -= used
+            closer.length -= used
+            #開き記号と閉じ記号の間を生成した要素で置き換える
+            token = inlineToken(instance)
+            opener.next = token
+            token.previous = opener
+            token.next = closer
+            closer.previous = token
+            #間にある記号はもう使われない
+            opener.next_delimiter = closer
+            closer.previous_delimiter = opener
+            if opener.length == 0:
+                opener.removeToken()
+                opener.removeDelimiter()
+            if closer.length == 0:
+                next_closer = closer.next_delimiter
+                closer.removeToken()
+                closer.removeDelimiter()
+                closer = next_closer
+        return
+
+    @staticmethod
+    def collectTokens(start, end):
+        #startからendの手前までのトークンをリストにする。連続する文字列は結合する。
+        collected = []
+        text_chunks = []
+        token = start
+        while token is not end:
+            if isinstance(token, delimiterRun):
+                value = token.char * token.length
+            else:
+                value = token.value
+            if isinstance(value, str):
+                text_chunks.append(value)
+            else:
+                if text_chunks:
+                    collected.append(''.join(text_chunks))
+                    text_chunks = []
+                collected.append(value)
+            token = token.next
+        if text_chunks:
+            collected.append(''.join(text_chunks))
+        return [item for item in collected if item != '']
 
     @staticmethod
     def countIndent(text):
-        blank = re.compile(r'\s')
-        count = 0
-        while blank.match(text):
-            count += 1
-            text = text.replace(' ', '', 1)
-        return count
+        #行頭の空白の幅を返す。タブは次のTAB_WIDTHの倍数の位置まで進める。
+        return blockObject.measureIndent(text)[0]
+
+    @staticmethod
+    def measureIndent(text):
+        """
+        This function will return the width of the leading whitespace of text
+        (tabs are expanded to the next multiple of TAB_WIDTH) and the index of
+        the first non-blank character.
+        """
+        column = len(text) - len(text.lstrip())
+        if '\t' not in text[:column]:
+            return column, column
+        width = 0
+        for char in text[:column]:
+            if char == '\t':
+                width += TAB_WIDTH - width % TAB_WIDTH
+            else:
+                width += 1
+        return width, column
 
     @staticmethod
-    def parseDefinitionBlock(text):
-        rule_id = re.compile(r"(\[)(?P<id>[^\[]+)(\]:)")
-        rule_option = re.compile(r'([\"\'\(])(?P<option>.*)\1')
+    def stripIndent(text, width):
+        #行頭の空白を、幅widthの分だけ取り除く。途中で切れたタブは空白に置き換える。
+        if text[:width] == ' ' * width:
+            return text[width:]
+        position = 0
+        index = 0
+        while index < len(text) and position < width and text[index] in ' \t':
+            if text[index] == '\t':
+                position += TAB_WIDTH - position % TAB_WIDTH
+            else:
+                position += 1
+            index += 1
+        return ' ' * (position - width if position > width else 0) + text[index:]
+
+    @staticmethod
+    def parseDefinition(text):
+        rule_id = definition_id
+        rule_option = definition_option
         #urlは、元のtextからidとoptional titleを取り除くことによって取得する。
         url = text
         optional_title = None
@@ -498,119 +2368,238 @@ class blockObject:
             url = rule_option.sub('', url)
         url = rule_id.sub('', url)
         url = url.strip()
-        #link_id_infoは、{id: {'url': url, 'optional_title': optional_title}, ...}
-        #という形式をとる。
+        #リンクのid情報は、{'url': url, 'optional_title': optional_title}という形式をとる。
         id_information = {}
         id_information['url'] = url
         id_information['optional_title'] = optional_title
-        link_id_info[id] = id_information
+        return id, id_information
+
+    def parseDefinitionBlock(self, text):
+        #referencesは文書ごとの辞書で、{id: {'url': url, 'optional_title': optional_title}, ...}
+        #という形式をとる。子要素はappendBlock()で親と同じ辞書を受け取る。
+        id, id_information = self.parseDefinition(text)
+        if self.references is None:
+            self.references = {}
+        #同じidが複数回定義された場合は、最初の定義を使う
+        self.references.setdefault(id, id_information)
         return
 
 class inlineObject:
     # this class will be inherited by inline objects.
+    __slots__ = ('rawdata', 'parsed_data')
+    start_tag = ''
+    end_tag = ''
+
     def __init__(self, string):
         self.rawdata = string
         self.parsed_data = []
-        self.start_tag = ''
-        self.end_tag = ''
 
-    def expandToHTML(self):
-        expanded_text = ""
+    def copy(self):
+        #凍結されていない浅いコピーを返す
+        instance_class = getattr(self.__class__, 'unfrozen_class', self.__class__)
+        instance = object.__new__(instance_class)
+        for slot_class in instance_class.__mro__:
+            for name in slot_class.__dict__.get('__slots__', ()):
+                if hasattr(self, name):
+                    setattr(instance, name, getattr(self, name))
+        if isinstance(getattr(instance, 'parsed_data', None), tuple):
+            instance.parsed_data = list(instance.parsed_data)
+        return instance
+
+    def resolveReferences(self, references):
+        """
+        This function will return this object with the link ids below it
+        resolved. Objects are never modified in place, since they may be
+        shared through inlineCache; a changed copy is returned instead.
+        """
+        if isinstance(self.parsed_data, str):
+            return self
+        resolved = []
+        changed = False
         for element in self.parsed_data:
-            if isinstance(element, defined_classes):
-                expanded_text += element.expandToHTML()
+            if isinstance(element, inlineObject):
+                resolved_element = element.resolveReferences(references)
+                changed = changed or resolved_element is not element
+                resolved.append(resolved_element)
             else:
-                expanded_text += element
-        return self.start_tag + '\n' + expanded_text + '\n' + self.end_tag
+                resolved.append(element)
+        if not changed:
+            return self
+        instance = self.copy()
+        instance.parsed_data = resolved
+        return instance
+
+    def freeze(self):
+        #inlineCacheに格納する際に呼ばれ、以降は属性を変更できなくなる。
+        #クラスを、属性の変更を禁止した派生クラス(frozen_classes)に切り替える。
+        if isinstance(self, frozenInline):
+            return
+        parsed_data = getattr(self, 'parsed_data', None)
+        if isinstance(parsed_data, list):
+            for element in parsed_data:
+                if isinstance(element, inlineObject):
+                    element.freeze()
+            self.parsed_data = tuple(parsed_data)
+        self.__class__ = frozen_classes[self.__class__]
+
+    def expandToHTML(self):
+        chunks = []
+        self.appendHTML(chunks)
+        return ''.join(chunks)
+
+    def appendHTML(self, chunks):
+        chunks.append(self.start_tag)
+        chunks.append('\n')
+        if isinstance(self.parsed_data, str):
+            chunks.append(self.parsed_data)
+        else:
+            for element in self.parsed_data:
+                if isinstance(element, defined_classes):
+                    element.appendHTML(chunks)
+                else:
+                    chunks.append(element)
+        chunks.append('\n')
+        chunks.append(self.end_tag)
+
+class frozenInline:
+    # inlineCacheで共有されるインライン要素のクラスに混ぜ、属性の変更を禁止する。
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError('cached inline objects are read-only')
+
+    def __delattr__(self, name):
+        raise AttributeError('cached inline objects are read-only')
+
+    def __setstate__(self, state):
+        #pickleからの復元時だけは、属性を直接設定する
+        __dict__, slots = state
+        for name, value in slots.items():
+            object.__setattr__(self, name, value)
 
 class root(blockObject):
-    def reset(self):
-        self.index = 0
-        self.text_buffer = []
-        self.start_tag = ""
-        self.end_tag = ''
+    #segment_lines, segment_sizesはparseIncremental()の結果だけが持つ。
+    #ブロックが開いていない位置で区切った行の並びごとの、行数とトップレベルの要素数。
+    __slots__ = ('segment_lines', 'segment_sizes')
+
+    def __init__(self, listed_data):
+        self.rawdata = listed_data
+        self.parsed_data = []
+        self.references = {}
+
+    def appendHTML(self, chunks):
+        #描画結果のキャッシュが有効なら、子要素のHTMLはキャッシュを通して得る
+        cache = render_cache
+        if cache is None:
+            blockObject.appendHTML(self, chunks)
+            return
+        chunks.append(self.start_tag)
+        chunks.append('\n')
+        for element in self.parsed_data:
+            if isinstance(element, blockObject):
+                chunks.append(cache.render(element))
+            elif isinstance(element, defined_classes):
+                element.appendHTML(chunks)
+            else:
+                chunks.append(element)
+            chunks.append('\n')
+        chunks.append('\n')
+        chunks.append(self.end_tag)
+        chunks.append('\n')
 
         
 class table(blockObject):
+    """
+    Cells are stored column by column: columns[j][i] is the cell of row i in
+    column j, and row_lengths[i] is the number of cells of row i (shorter
+    rows are padded with '' in columns). Rows are rendered one at a time,
+    so a large table can be written to a sink without building its HTML.
+    """
+    __slots__ = ('headers', 'alignments', 'columns', 'row_lengths')
+
     def __init__(self, listed_data):
         self.rawdata = listed_data
         self.headers = []
         self.alignments = []
-        self.contents = []
-        self.reset()
-        
-    def reset(self):
-        self.index = 0
-        self.text_buffer = []
+        self.columns = []
+        self.row_lengths = array.array('l')
 
     def parse(self):
         # 2行目の要素によって、|---|---|タイプか---|---タイプかを判別し、場合分けする。
-        formal = re.compile(r'\s*\|')
-        informal = re.compile(r'\s*[^ \|]')
-        if formal.match(self.rawdata[1]):
-            # [1,2,3,4,5][1:-1] = [2,3,4]
-            self.headers = self.rawdata[self.index].split('|')[1:-1]
-            self.index += 1
-            self.alignments = self.rawdata[self.index].split('|')[1:-1]
-            self.index += 1
-            while self.index < len(self.rawdata):
-                self.contents.append(self.rawdata[self.index].split('|')[1:-1])
-                self.index += 1
-                
-        if informal.match(self.rawdata[1]):
-            self.headers = self.rawdata[self.index].split('|')
-            self.index += 1
-            self.alignments = self.rawdata[self.index].split('|')
-            self.index += 1
-            while self.index < len(self.rawdata):
-                self.contents.append(self.rawdata[self.index].split('|'))
-                self.index += 1
+        # |---|---|タイプは、[1,2,3,4,5][1:-1] = [2,3,4]のように両端を除く。
+        if table_formal.match(self.rawdata[1]):
+            start, end = 1, -1
+        elif table_informal.match(self.rawdata[1]):
+            start, end = 0, None
+        else:
+            del self.rawdata
+            return
+        self.headers = self.splitCells(self.rawdata[0])[start:end]
         # 2行目の要素からalignmentの判断をする
-        left_align = re.compile(r'\s*\:(\-{3,})\s*$')
-        right_align = re.compile(r'(\s*\-{3,})\:\s*$')
-        center_align = re.compile(r'\s*\:(\-{3,})\:\s*$')
-        j = 0
-        while j < len(self.alignments):
-            if left_align.match(self.alignments[j]):
-                self.alignments[j] = 'left'
-            elif right_align.match(self.alignments[j]):
-                self.alignments[j] = 'right'
-            elif center_align.match(self.alignments[j]):
-                self.alignments[j] = 'center'
-            else:
-                self.alignments[j] = None
-            j += 1
+        self.alignments = [self.parseAlignment(cell) for cell in self.splitCells(self.rawdata[1])[start:end]]
+        rows = [self.splitCells(line)[start:end] for line in itertools.islice(self.rawdata, 2, None)]
+        self.row_lengths = array.array('l', map(len, rows))
+        #行を列に並べ替える。短い行は''で埋める。
+        width = max(self.row_lengths, default=0)
+        if width > 0:
+            rows = [row if len(row) == width else row + [''] * (width - len(row)) for row in rows]
+            self.columns = [list(column) for column in zip(*rows)]
         del self.rawdata
         return
 
-    def expandToHTML(self):
-        expanded_text = ''
-        # ヘッダ要素の処理
-        for item in self.headers:
-            expanded_text += '<th>' + item + '</th>' + '\n'
-        expanded_text = '<tr>' + '\n' + expanded_text + '\n' + '</tr>' + '\n'
-        # 中身要素の処理
-        for row in self.contents:
-            expanded_text += '<tr>' + '\n'
-            index = 0
-            while index < len(row):
-                if self.alignments[index]:
-                    expanded_text += '<td align="{}">'.format(self.alignments[index]) + item + '</td>' + '\n'
-                else:
-                    expanded_text += '<td>' + item + '</td>' + '\n'
-                index += 1
-            expanded_text += '</tr>' + '\n'
-        return '<table>' + '\n' + expanded_text + '\n' + '</table>'
+    @staticmethod
+    def splitCells(line):
+        #'|'で区切る。'\|'はセルの中の'|'として扱う。
+        if '\\|' not in line:
+            return line.split('|')
+        return [cell.replace('\\|', '|') for cell in table_separator.split(line)]
+
+    @staticmethod
+    def parseAlignment(cell):
+        if table_left_align.match(cell):
+            return 'left'
+        if table_right_align.match(cell):
+            return 'right'
+        if table_center_align.match(cell):
+            return 'center'
+        return None
+
+    def updateReferences(self, references):
+        return False
+
+    def cellTags(self):
+        #列ごとのセルの開始タグ。alignmentは列ごとに1度だけ判断する。
+        tags = ['<td align="{}">'.format(alignment) if alignment else '<td>' for alignment in self.alignments]
+        while len(tags) < len(self.columns):
+            tags.append('<td>')
+        return tags
+
+    def iterHTML(self):
+        #HTMLを、ヘッダと各行の単位で順に返す。
+        yield '<table>\n<tr>\n' + ''.join('<th>' + item + '</th>\n' for item in self.headers) + '\n</tr>\n'
+        columns = self.columns
+        tags = self.cellTags()
+        for row, length in enumerate(self.row_lengths):
+            yield '<tr>\n' + ''.join([tags[column] + columns[column][row] + '</td>\n' for column in range(length)]) + '</tr>\n'
+        yield '\n</table>'
+
+    def appendHTML(self, chunks):
+        chunks.extend(self.iterHTML())
+
+    def writeHTML(self, sink):
+        #行ごとにsinkへ書き出す
+        for chunk in self.iterHTML():
+            sink.write(chunk)
 
 
 class blockQuote(blockObject):
-    def reset(self):
-        self.index = 0
-        self.text_buffer = []
-        self.start_tag = '<blockquote>'
-        self.end_tag = '</blockquote>'
+    __slots__ = ()
+    start_tag = '<blockquote>'
+    end_tag = '</blockquote>'
 
 class headers(blockObject):
+    __slots__ = ('level',)
+
     def __init__(self, data, level=None):
         if level:
             self.level = level
@@ -619,7 +2608,6 @@ class headers(blockObject):
             self.rawdata = data
             self.parsed_data = []
             self.level = None
-            self.reset()
 
     def parse(self):
         if self.level == None:
@@ -628,22 +2616,18 @@ class headers(blockObject):
             del self.rawdata
         return
 
-    def expandToHTML(self):
-        expanded_text = ''
-        expanded_text += '<h{}>'.format(self.level) + self.parsed_data + '</h{}>'.format(self.level) + '\n'
-        return expanded_text
+    def appendHTML(self, chunks):
+        chunks.append('<h{}>'.format(self.level) + self.parsed_data + '</h{}>'.format(self.level) + '\n')
 
     @staticmethod
     def countSharp(text):
+        #行頭の'#'の数を数える
         text = text.lstrip()
-        sharp = re.compile(r'\#')
-        count = 0
-        while sharp.match(text):
-            count += 1
-            text = text.replace('#', '', 1)
-        return count
+        return len(text) - len(text.lstrip('#'))
 
 class taggedBlock(blockObject):
+    __slots__ = ()
+
     def parse(self):
         # 何もせずにparsed_dataへ格納
         for line in self.rawdata:
@@ -651,174 +2635,147 @@ class taggedBlock(blockObject):
         del self.rawdata
         return
 
-    def reset(self):
-        self.index = 0
-        self.text_buffer = []
-        self.start_tag = ''
-        self.end_tag = ''
-
-class ulLists(blockObject):
-    def reset(self):
-        self.index = 0
-        self.base_buffer = []
-        self.nested_buffer = []
-        self.start_tag = '<ul>'
-        self.end_tag = '</ul>'
+class listBlock(blockObject):
+    """
+    This class is inherited by ulLists and olLists.
+    A list is built in one pass: each line is handed to the list item it
+    belongs to as soon as it is fed, and the item parses it at once with its
+    own feeder. Nested lists are built the same way inside the items, so the
+    lines are not collected and parsed again for every nesting level.
+    """
+    #base_indentはリストの最初の行のインデント。
+    #base_itemはリストの記号で始まる行のアイテム、nested_itemは入れ子の行を集めたアイテムで、
+    #両方が同時に解析中になることもある。
+    __slots__ = ('base_indent', 'base_item', 'nested_item')
+    own_kind = None
+    marker = None
 
     def parse(self):
-        base_indent = self.countIndent(self.rawdata[0])
+        #行をまとめて渡された場合も、1行ずつ処理する
+        self.startList(self.countIndent(self.rawdata[0]))
         for line in self.rawdata:
-            current_line_indent = self.countIndent(line)
-            if block_rules['ulLists'].match(line):
-                if current_line_indent <= base_indent + 1:
-                    if len(self.nested_buffer) > 0:
-                        instance = listItem(self.nested_buffer)
-                        instance.parse()
-                        self.parsed_data.append(instance)
-                        self.nested_buffer = []
-                    stripped_text = re.sub(r'\s*[\*\+\-]\s', '', line, 1)
-                    self.base_buffer.append(stripped_text)
-                    continue
-                else:
-                    if len(self.base_buffer) > 0:
-                        instance = listItem(self.base_buffer)
-                        instance.parse()
-                        self.parsed_data.append(instance)
-                        self.base_buffer = []
-                    stripped_text = line.replace(' ', '', base_indent)
-                    self.nested_buffer.append(stripped_text)
-                    continue
-            elif block_rules['olLists'].match(line):
-                if len(self.base_buffer) > 0:
-                    instance = listItem(self.base_buffer)
-                    instance.parse()
-                    self.parsed_data.append(instance)
-                    self.base_buffer = []
-                stripped_text = line.replace(' ', '', base_indent)
-                self.nested_buffer.append(stripped_text)
-                continue
-            elif blank_line.match(line):
-                if len(self.base_buffer) > 0:
-                    self.base_buffer.append(line)
-                else:
-                    self.nested_buffer.append(line)
-                continue
-            else:
-                if current_line_indent >= base_indent + 2:
-                    stripped_text = line.replace(' ', '', base_indent)
-                    self.nested_buffer.append(stripped_text)
-                    continue
-                else:
-                    stripped_text = line.lstrip()
-                    self.base_buffer.append(stripped_text)
-                    continue
-        #最後にtext_bufferが残っていたら処理する。
-        if len(self.base_buffer) > 0:
-            instance = listItem(self.base_buffer)
-            instance.parse()
-            self.parsed_data.append(instance)
-            self.base_buffer = []
-        if len(self.nested_buffer) > 0:
-            instance = listItem(self.nested_buffer)
-            instance.parse()
-            self.parsed_data.append(instance)
-            self.nested_buffer = []
+            indent, column = self.measureIndent(line)
+            self.feedListLine(line, 0, indent, column, self.classifyListLine(line))
+        self.closeList()
         del self.rawdata
         return
-            
-class olLists(blockObject):
-    def reset(self):
-        self.index = 0
-        self.base_buffer = []
-        self.nested_buffer = []
-        self.start_tag = '<ol>'
-        self.end_tag = '</ol>'
 
-    def parse(self):
-        base_indent = self.countIndent(self.rawdata[0])
-        for line in self.rawdata:
-            current_line_indent = self.countIndent(line)
-            if block_rules['olLists'].match(line):
-                if current_line_indent <= base_indent + 1:
-                    if len(self.nested_buffer) > 0:
-                        instance = listItem(self.nested_buffer)
-                        instance.parse()
-                        self.parsed_data.append(instance)
-                        self.nested_buffer = []
-                    stripped_text = re.sub(r'\s*[0-9]+\.\s', '', line, 1)
-                    self.base_buffer.append(stripped_text)
-                    continue
-                else:
-                    if len(self.base_buffer) > 0:
-                        instance = listItem(self.base_buffer)
-                        instance.parse()
-                        self.parsed_data.append(instance)
-                        self.base_buffer = []
-                    stripped_text = line.replace(' ', '', base_indent)
-                    self.nested_buffer.append(stripped_text)
-                    continue
-            elif block_rules['ulLists'].match(line):
-                if len(self.base_buffer) > 0:
-                    instance = listItem(self.base_buffer)
-                    instance.parse()
-                    self.parsed_data.append(instance)
-                    self.base_buffer = []
-                stripped_text = line.replace(' ', '', base_indent)
-                self.nested_buffer.append(stripped_text)
-                continue
-            elif blank_line.match(line):
-                if len(self.base_buffer) > 0:
-                    self.base_buffer.append(line)
+    def startList(self, base_indent):
+        self.base_indent = base_indent
+        self.base_item = None
+        self.nested_item = None
+
+    def feedListLine(self, line, offset, indent, column, kind):
+        """
+        This function will feed a line of the list to the list item it
+        belongs to. The text of the line at this list is line[offset:],
+        indent and column are the values of measureIndent() for that text and
+        kind is the value of classifyListLine(line).
+        A nested line goes down the chain of open nested lists by moving
+        offset past the indent of each list, and only the innermost item
+        gets the rest of the line, so the line is not copied at every level.
+        """
+        block = self
+        #行頭が空白だけなら、各リストではそのインデントの分だけoffsetを進める
+        plain = line.startswith(' ' * column, offset)
+        while True:
+            base_indent = block.base_indent
+            nested_item = block.nested_item
+            if kind == block.own_kind and indent <= base_indent + 1:
+                #リストの行は、行頭の記号を取り除いてアイテムに渡す
+                block.nested_item = block.closeItem(nested_item)
+                if block.base_item is None:
+                    block.base_item = block.startItem()
+                block.base_item.feedLine(line[block.marker.match(line, offset).end():])
+                return
+            if kind == LINE_BLANK and (nested_item is None or nested_item.state != STATE_FENCED_CODE):
+                if block.base_item is not None:
+                    block.base_item.feedLine(line[offset:])
+                    return
+                #アイテムの無い空行は、インデントを取り除かずに入れ子のアイテムへ渡す
+                if nested_item is None:
+                    nested_item = block.nested_item = block.startItem()
+            elif kind == LINE_UL or kind == LINE_OL or kind == LINE_BLANK or indent >= base_indent + 2:
+                #入れ子のリストの行、インデントされた行と、フェンスで囲まれたコードの中の空行
+                if (kind == LINE_UL or kind == LINE_OL) and block.base_item is not None:
+                    block.base_item = block.closeItem(block.base_item)
+                if plain and column >= base_indent:
+                    offset += base_indent
+                    indent -= base_indent
+                    column -= base_indent
                 else:
-                    self.nested_buffer.append(line)
-                continue
+                    line = block.stripIndent(line[offset:], base_indent)
+                    offset = 0
+                    indent, column = block.measureIndent(line)
+                    plain = line.startswith(' ' * column)
+                if nested_item is None:
+                    nested_item = block.nested_item = block.startItem()
             else:
-                if current_line_indent >= base_indent + 2:
-                    stripped_text = line.replace(' ', '', base_indent)
-                    self.nested_buffer.append(stripped_text)
+                if block.base_item is None:
+                    block.base_item = block.startItem()
+                block.base_item.feedLine(line[offset + column:])
+                return
+            #入れ子のアイテムで解析中のリストに続く行は、そのリストへ進む
+            nested_item.index += 1
+            if nested_item.state == STATE_UL_LISTS or nested_item.state == STATE_OL_LISTS:
+                inner = nested_item.open_block
+                if kind == inner.own_kind or kind == LINE_BLANK or indent >= inner.base_indent + 2:
+                    block = inner
                     continue
-                else:
-                    stripped_text = line.lstrip()
-                    self.base_buffer.append(stripped_text)
-                    continue
-        #最後にtext_bufferが残っていたら処理する。
-        if len(self.base_buffer) > 0:
-            instance = listItem(self.base_buffer)
-            instance.parse()
-            self.parsed_data.append(instance)
-            self.base_buffer = []
-        if len(self.nested_buffer) > 0:
-            instance = listItem(self.nested_buffer)
-            instance.parse()
-            self.parsed_data.append(instance)
-            self.nested_buffer = []
-        del self.rawdata
-        return
+                nested_item.state = nested_item.closeLists(line[offset:])
+            else:
+                nested_item.state = nested_item.state_handlers[nested_item.state](nested_item, line[offset:])
+            return
+
+    def startItem(self):
+        item = listItem([])
+        item.references = self.references
+        item.startFeed()
+        return item
+
+    def closeItem(self, item):
+        #アイテムを確定させてparsed_dataに追加する。常にNoneを返す。
+        if item is not None:
+            item.closeFeed()
+            item.releaseFeed()
+            self.parsed_data.append(item)
+        return None
+
+    def closeList(self):
+        self.closeItem(self.base_item)
+        self.closeItem(self.nested_item)
+        del self.base_indent, self.base_item, self.nested_item
+
+class ulLists(listBlock):
+    __slots__ = ()
+    start_tag = '<ul>'
+    end_tag = '</ul>'
+    own_kind = LINE_UL
+    marker = re.compile(r'\s*[\*\+\-]\s')
+
+class olLists(listBlock):
+    __slots__ = ()
+    start_tag = '<ol>'
+    end_tag = '</ol>'
+    own_kind = LINE_OL
+    marker = re.compile(r'\s*[0-9]+\.\s')
 
 class listItem(blockObject):
-    def reset(self):
-        self.index = 0
-        self.text_buffer = []
-        self.start_tag = '<li>'
-        self.end_tag = '</li>'
+    __slots__ = ()
+    start_tag = '<li>'
+    end_tag = '</li>'
 
 class horizontalRule(blockObject):
+    __slots__ = ()
+    start_tag = '<hr>'
+
     def __init__(self, listed_data):
         self.parsed_data = []
-        self.reset()
-    
-    def reset(self):
-        self.index = 0
-        self.text_buffer = []
-        self.start_tag = '<hr>'
-        self.end_tag = ''
 
 class codeBlock(blockObject):
-    def reset(self):
-        self.index = 0
-        self.text_buffer = []
-        self.start_tag = '<pre><code>'
-        self.end_tag = '</code></pre>'
+    __slots__ = ()
+    start_tag = '<pre><code>'
+    end_tag = '</code></pre>'
 
     def parse(self):
         # 何もせずにparsed_dataへ格納
@@ -827,50 +2784,135 @@ class codeBlock(blockObject):
         del self.rawdata
         return
 
+    def updateReferences(self, references):
+        #コードの行は文字列のままなので、解決するリンクはない
+        return False
+
+class fencedCodeBlock(codeBlock):
+    #```か~~~で囲まれたコード。本文の行は解析せず、そのままparsed_dataにする。
+    #fenceは開始行のフェンス、infoはその後の文字列、indentは開始行のインデント。
+    __slots__ = ('fence', 'info', 'indent')
+
+    def parse(self):
+        self.parsed_data = self.rawdata
+        del self.rawdata
+
+    @property
+    def start_tag(self):
+        return self.startTag(self.info)
+
+    @staticmethod
+    def startTag(info):
+        #info文字列の最初の単語を言語名とする
+        if info:
+            return '<pre><code class="language-{}">'.format(info.split()[0])
+        return codeBlock.start_tag
+
+    @staticmethod
+    def isClosingFence(text, fence):
+        #開始行のフェンスと同じ記号だけが、同じ長さ以上並んだ行。インデントは3まで。
+        stripped_text = text.strip()
+        return (stripped_text.startswith(fence) and not stripped_text.strip(fence[0])
+                and len(text) - len(text.lstrip()) < 4)
+
+    def findClosingFence(self, lines, position):
+        #閉じるフェンスの行の位置を返す。なければlen(lines)を返す。
+        fence = self.fence
+        for index in range(position, len(lines)):
+            if fence in lines[index] and self.isClosingFence(lines[index], fence):
+                return index
+        return len(lines)
+
+    def appendLines(self, lines):
+        #開始行がインデントされていれば、本文の各行からも同じ幅だけ取り除く
+        if self.indent:
+            self.rawdata.extend(self.stripIndent(line, self.indent) for line in lines)
+        else:
+            self.rawdata.extend(lines)
+
 class normalBlock(blockObject):
-    def reset(self):
-        self.index = 0
-        self.text_buffer = []
-        self.start_tag = ''
-        self.end_tag = ''
+    __slots__ = ()
+
+class inlineToken:
+    # parseInlineElements()の処理中に、文字列とインライン要素をつなぐ双方向リストの要素。
+    __slots__ = ('value', 'previous', 'next')
+
+    def __init__(self, value):
+        self.value = value
+        self.previous = None
+        self.next = None
+
+    def append(self, token):
+        self.next = token
+        token.previous = self
+        return token
+
+    def removeToken(self):
+        self.previous.next = self.next
+        if self.next:
+            self.next.previous = self.previous
+
+class delimiterRun(inlineToken):
+    # '*', '_', '~'の連続。lengthは未使用の記号の数。
+    __slots__ = ('char', 'length', 'original_length', 'can_open', 'can_close',
+                 'previous_delimiter', 'next_delimiter')
+
+    def __init__(self, char, length, can_open, can_close):
+        self.value = None
+        self.previous = None
+        self.next = None
+        self.char = char
+        self.length = length
+        self.original_length = length
+        self.can_open = can_open
+        self.can_close = can_close
+        self.previous_delimiter = None
+        self.next_delimiter = None
+
+    def removeDelimiter(self):
+        if self.previous_delimiter:
+            self.previous_delimiter.next_delimiter = self.next_delimiter
+        if self.next_delimiter:
+            self.next_delimiter.previous_delimiter = self.previous_delimiter
 
 class lineBreak(inlineObject):
-    def __init__(self, string):
-        self.rawdata = string
-        self.parsed_data = []
-        self.start_tag = ''
-        self.end_tag = '</br>'
-        
+    __slots__ = ()
+    end_tag = '</br>'
+
     def shapeData(self):
         del self.rawdata
         return
 
 
 class links(inlineObject):
+    __slots__ = ('title', 'url', 'id', 'reference')
+    rule_url = re.compile(r'''
+    \[
+        (?P<title> [^ \[]+)
+    \]
+    \(
+        (?P<url> [^\(]*?)
+    \)
+    ''', re.VERBOSE)
+    rule_id = re.compile(r'''
+    \[
+        (?P<title> [^ \[]+)
+    \]
+    \[
+        (?P<id> [^\[]*?)
+    \]
+    ''', re.VERBOSE)
+
     def __init__(self, string):
         self.rawdata = string
         self.title = ""
         self.url = None
         self.id = None
-        
+        self.reference = None
 
     def shapeData(self):
-        rule_url = re.compile(r'''
-        \[
-            (?P<title> [^ \[]+)
-        \]
-        \(
-            (?P<url> [^\(]*?)
-        \)
-        ''', re.VERBOSE)
-        rule_id = re.compile(r'''
-        \[
-            (?P<title> [^ \[]+)
-        \]
-        \[
-            (?P<id> [^\[]*?)
-        \]
-        ''', re.VERBOSE)
+        rule_url = self.rule_url
+        rule_id = self.rule_id
 
         if rule_url.search(self.rawdata):
             self.title = rule_url.search(self.rawdata).group('title')
@@ -883,41 +2925,54 @@ class links(inlineObject):
         del self.rawdata
         return
 
-    def expandToHTML(self):
-        expanded_text = ""
-        expanded_text += '<a'
+    def resolveReferences(self, references):
+        #idで参照されるURLを、文書のreferencesから解決する。未定義のidは解決しない。
+        if self.url or not self.id:
+            return self
+        reference = references.get(self.id)
+        if reference is None or reference is self.reference:
+            return self
+        instance = self.copy()
+        instance.reference = reference
+        return instance
+
+    def appendHTML(self, chunks):
+        chunks.append('<a')
         if self.url:
-            expanded_text += ' href="{}"'.format(self.url)
-        elif self.id:
-            expanded_text += ' href="{}"'.format(link_id_info[self.id]['url'])
-        expanded_text += '>' + self.title + '</a>' + '\n'
-        return expanded_text
+            chunks.append(' href="{}"'.format(self.url))
+        elif self.reference:
+            chunks.append(' href="{}"'.format(self.reference['url']))
+        chunks.append('>' + self.title + '</a>\n')
 
 class images(inlineObject):
+    __slots__ = ('title', 'url', 'id', 'reference')
+    rule_url = re.compile(r'''
+    \!\[
+        (?P<title> [^ \[]+)
+    \]
+    \(
+        (?P<url> [^\(]*?)
+    \)
+    ''', re.VERBOSE)
+    rule_id = re.compile(r'''
+    \!\[
+        (?P<title> [^ \[]+)
+    \]
+    \[
+        (?P<id> [^\[]*?)
+    \]
+    ''', re.VERBOSE)
+
     def __init__(self, string):
         self.rawdata = string
         self.title = ""
         self.url = None
         self.id = None
-        
+        self.reference = None
 
     def shapeData(self):
-        rule_url = re.compile(r'''
-        \!\[
-            (?P<title> [^ \[]+)
-        \]
-        \(
-            (?P<url> [^\(]*?)
-        \)
-        ''', re.VERBOSE)
-        rule_id = re.compile(r'''
-        \!\[
-            (?P<title> [^ \[]+)
-        \]
-        \[
-            (?P<id> [^\[]*?)
-        \]
-        ''', re.VERBOSE)
+        rule_url = self.rule_url
+        rule_id = self.rule_id
 
         if rule_url.search(self.rawdata):
             self.title = rule_url.search(self.rawdata).group('title')
@@ -930,75 +2985,64 @@ class images(inlineObject):
         del self.rawdata
         return
 
-    def expandToHTML(self):
-        expanded_text = ""
-        expanded_text += '<img'
+    def resolveReferences(self, references):
+        #idで参照されるURLを、文書のreferencesから解決する。未定義のidは解決しない。
+        if self.url or not self.id:
+            return self
+        reference = references.get(self.id)
+        if reference is None or reference is self.reference:
+            return self
+        instance = self.copy()
+        instance.reference = reference
+        return instance
+
+    def appendHTML(self, chunks):
+        chunks.append('<img')
         if self.url:
-            expanded_text += ' src="{}"'.format(self.url)
-        elif self.id:
-            expanded_text += ' src="{}"'.format(link_id_info[self.id]['url'])
-            if link_id_info[self.id]['optional_title']:
-                expanded_text += ' alt="{}"'.format(link_id_info[self.id]['optional_title'])
+            chunks.append(' src="{}"'.format(self.url))
+        elif self.reference:
+            chunks.append(' src="{}"'.format(self.reference['url']))
+            if self.reference['optional_title']:
+                chunks.append(' alt="{}"'.format(self.reference['optional_title']))
             else:
-                expanded_text += ' alt=""'
-        expanded_text += '>'
-        return expanded_text
+                chunks.append(' alt=""')
+        chunks.append('>')
 
 class boldFont(inlineObject):
-    def __init__(self, string):
-        self.rawdata = string
-        self.parsed_data = []
-        self.start_tag = '<b>'
-        self.end_tag = '</b>'
-        
-    def shapeData(self):
-        rule = re.compile(r'(\*\*|\_\_)(?P<content>.*?)\1')
-        shaped_text = rule.search(self.rawdata).group('content').strip()
-        self.parsed_data = shaped_text
-        del self.rawdata
-        return
+    __slots__ = ()
+    start_tag = '<b>'
+    end_tag = '</b>'
+
+    def __init__(self, parsed_data):
+        self.parsed_data = parsed_data
 
 
 class emphasizedFont(inlineObject):
-    def __init__(self, string):
-        self.rawdata = string
-        self.parsed_data = []
-        self.start_tag = '<em>'
-        self.end_tag = '</em>'
-        
-    def shapeData(self):
-        rule = re.compile(r'(\*|\_)(?P<content>.*?)\1')
-        shaped_text = rule.search(self.rawdata).group('content').strip()
-        self.parsed_data = shaped_text
-        del self.rawdata
-        return
+    __slots__ = ()
+    start_tag = '<em>'
+    end_tag = '</em>'
+
+    def __init__(self, parsed_data):
+        self.parsed_data = parsed_data
 
 
 class deletedFont(inlineObject):
-    def __init__(self, string):
-        self.rawdata = string
-        self.parsed_data = []
-        self.start_tag = '<strike>'
-        self.end_tag = '</strike>'
-        
-    def shapeData(self):
-        rule = re.compile(r'(\~\~)(?P<content>.*?)\1')
-        shaped_text = rule.search(self.rawdata).group('content').strip()
-        self.parsed_data = shaped_text
-        del self.rawdata
-        return
+    __slots__ = ()
+    start_tag = '<strike>'
+    end_tag = '</strike>'
+
+    def __init__(self, parsed_data):
+        self.parsed_data = parsed_data
 
 
 class inlineCode(inlineObject):
-    def __init__(self, string):
-        self.rawdata = string
-        self.parsed_data = []
-        self.start_tag = '<code>'
-        self.end_tag = '</code>'
-        
+    __slots__ = ()
+    start_tag = '<code>'
+    end_tag = '</code>'
+    rule = re.compile(r'(`{1,})(?P<content>.*?)\1')
+
     def shapeData(self):
-        rule = re.compile(r'(`{1,})(?P<content>.*?)\1')
-        shaped_text = rule.search(self.rawdata).group('content').strip()
+        shaped_text = self.rule.search(self.rawdata).group('content').strip()
         self.parsed_data = shaped_text
         del self.rawdata
         return
@@ -1011,6 +3055,7 @@ defined_classes = (
     headers,
     taggedBlock,
     codeBlock,
+    fencedCodeBlock,
     ulLists,
     olLists,
     listItem,
@@ -1023,4 +3068,44 @@ defined_classes = (
     emphasizedFont,
     deletedFont,
     inlineCode,
-)
\ No newline at end of file
+)
+
+#インライン要素のルール名と、生成するクラスの対応
+inline_classes = {
+    'LineBreak'      : lineBreak,
+    'InlineCode'     : inlineCode,
+    'Images'         : images,
+    'Links'          : links,
+}
+
+#inlineCacheに格納されたインライン要素のクラスと、その読み取り専用版の対応。
+#pickleで復元できるよう、モジュールの名前空間にも登録する。
+frozen_classes = {}
+for inline_class in (lineBreak, links, images, boldFont, emphasizedFont, deletedFont, inlineCode, inlineObject):
+    frozen_name = 'frozen' + inline_class.__name__[0].upper() + inline_class.__name__[1:]
+    frozen_classes[inline_class] = type(frozen_name, (frozenInline, inline_class),
+                                        {'__slots__': (), 'unfrozen_class': inline_class})
+    globals()[frozen_name] = frozen_classes[inline_class]
+del inline_class, frozen_name
+
+#子要素の後に改行を入れる、blockObject.appendHTML()で描画される要素の種類
+flatDocument.block_types = frozenset(
+    FLAT_CLASS_OFFSET + index for index, element_class in enumerate(defined_classes)
+    if issubclass(element_class, blockObject) and element_class not in (table, headers)
+)
+
+#dumps()で書く、defined_classesの各クラスのスロットの名前(基底クラスのものから順に)と、loads()でそれを設定する関数。
+#読み取り専用のインライン要素は、元のクラスとして書く。
+dump_slots = tuple(
+    tuple(name for slot_class in reversed(element_class.__mro__) for name in slot_class.__dict__.get('__slots__', ()))
+    for element_class in defined_classes
+)
+dump_setters = tuple(
+    tuple(slot_class.__dict__[name].__set__ for slot_class in reversed(element_class.__mro__) for name in slot_class.__dict__.get('__slots__', ()))
+    for element_class in defined_classes
+)
+dump_codes = {element_class: code for code, element_class in enumerate(defined_classes)}
+for inline_class, frozen_class in frozen_classes.items():
+    if inline_class in dump_codes:
+        dump_codes[frozen_class] = dump_codes[inline_class]
+del inline_class, frozen_class
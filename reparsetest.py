@@ -0,0 +1,81 @@
+import random
+import sys
+import time
+
+import benchmark
+import mmparser
+
+
+#編集で挿入する行。様々なブロックの開始や終了になる行を含む。
+edit_lines = [
+    '', '', 'text', 'more **text**', '# header', 'Title', '===', '---', '* item', '  * nested', '1. first',
+    '> quote', '>> nested quote', '    code', '```', '```python', '~~~', '| a | b |', '|---|---|',
+    '<p> tagged', 'end </p>', '[link][id]', '[id]: http://example.com/',
+]
+
+#決まった文書と、そのHTMLに含まれるべき部分
+fixed_cases = [
+    #リストの中のフェンスで囲まれたコードの空行は、コードに残る
+    ('* item\n\n  ```\n  code\n\n  more\n  ```\n* next\n', '<pre><code>\ncode\n\nmore\n'),
+]
+
+def makeDocument():
+    with open('test_document.md', 'rt', encoding='utf-8') as f:
+        text = f.read()
+    return text + benchmark.makeFencedCode(200) + benchmark.makeOutline(200) + benchmark.makeTable(50)
+
+def randomEdit(lines):
+    # 変更する行の範囲と、新しい行
+    start = random.randint(0, len(lines))
+    end = min(len(lines), start + random.choice((0, 0, 1, 1, 2, 5)))
+    new_lines = [random.choice(edit_lines) for _ in range(random.choice((0, 1, 1, 2, 3)))]
+    return start, end, new_lines
+
+def runFixedCases():
+    # 決まった文書を解析し、HTMLに期待する部分が含まれるか確かめる
+    parser = mmparser.MarkdownParser()
+    failures = 0
+    for text, expected in fixed_cases:
+        html = parser.parse(text).expandToHTML()
+        if expected not in html:
+            failures += 1
+            print('differs: {!r}: {!r} not in {!r}'.format(text, expected, html))
+    print('fixed cases: {} / {} differ'.format(failures, len(fixed_cases)))
+    return failures
+
+def runReparseTest(edits=2000, seed=1):
+    # 1文書に編集を繰り返し、毎回reparse()の結果と文書全体を解析し直した結果を比べる
+    random.seed(seed)
+    parser = mmparser.MarkdownParser()
+    document = parser.parseIncremental(makeDocument())
+    failures = 0
+    for count in range(edits):
+        start, end, new_lines = randomEdit(document.rawdata)
+        parser.reparse(document, start, end, new_lines)
+        expected = parser.parse('\n'.join(document.rawdata)).expandToHTML()
+        if document.expandToHTML() != expected:
+            failures += 1
+            print('differs after edit {}: lines {}-{} -> {!r}'.format(count, start, end, new_lines))
+            document = parser.parseIncremental('\n'.join(document.rawdata))
+    print('reparse: {} / {} edits differ from a full parse'.format(failures, edits))
+    return failures
+
+def benchmarkReparse(copies=200):
+    # 多数の小さなブロックからなる長い文書の中ほどの1行を書き換えたときの時間を、全体の解析と比べる
+    # (1つの巨大なリストや段落の中の編集では、そのブロック全体を解析し直す)
+    parser = mmparser.MarkdownParser()
+    with open('test_document.md', 'rt', encoding='utf-8') as f:
+        text = f.read() * copies
+    start = time.perf_counter()
+    document = parser.parseIncremental(text)
+    full = time.perf_counter() - start
+    middle = len(document.rawdata) // 2
+    start = time.perf_counter()
+    parser.reparse(document, middle, middle + 1, ['* edited *line*'])
+    partial = time.perf_counter() - start
+    print('{} lines: full parse {:8.4f} s, reparse of 1 line {:8.4f} s'.format(len(document.rawdata), full, partial))
+
+if __name__ == '__main__':
+    failures = runFixedCases() + runReparseTest()
+    benchmarkReparse()
+    sys.exit(1 if failures else 0)
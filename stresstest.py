@@ -0,0 +1,55 @@
+import concurrent.futures
+import sys
+
+import benchmark
+import mmparser
+
+
+def makeDocuments():
+    # 様々な要素を含む文書と、それぞれの大きさを変えたもの
+    with open('test_document.md', 'rt', encoding='utf-8') as f:
+        documents = [f.read()]
+    for size in (50, 200, 1000):
+        documents.append(benchmark.makeTable(size))
+        documents.append(benchmark.makeList(size))
+        documents.append(benchmark.makeParagraph(size))
+        documents.append(benchmark.makeOutline(size))
+        documents.append(benchmark.makeQuoteThread(size))
+        documents.append(benchmark.makeFencedCode(size))
+    return documents
+
+def renderSerial(documents):
+    return [mmparser.parse(text).expandToHTML() for text in documents]
+
+def stressParse(documents, expected, workers, rounds):
+    # 同じ文書を多数のスレッドから同時に解析し、1スレッドで解析した結果と比べる
+    # 1つのMarkdownParserを全てのスレッドで共有する
+    parser = mmparser.MarkdownParser()
+    tasks = [index for index in range(len(documents))] * rounds
+    failures = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(lambda index: (index, parser.parse(documents[index]).expandToHTML()), tasks)
+        for index, html in results:
+            if html != expected[index]:
+                failures += 1
+    return failures, len(tasks)
+
+def runStressTest(workers=8, rounds=10):
+    documents = makeDocuments()
+    expected = renderSerial(documents)
+    total_failures = 0
+    for cache_size in (None, 64, 4096):
+        # キャッシュなし、追い出しが頻発する小さなキャッシュ、十分なキャッシュの3通り
+        if cache_size is None:
+            mmparser.disableInlineCache()
+        else:
+            mmparser.enableInlineCache(maxsize=cache_size)
+        failures, count = stressParse(documents, expected, workers, rounds)
+        print('threads: {}, cache: {}: {} / {} documents differ'.format(workers, cache_size, failures, count))
+        total_failures += failures
+    mmparser.disableInlineCache()
+    return total_failures
+
+
+if __name__ == '__main__':
+    sys.exit(1 if runStressTest() else 0)